@@ -0,0 +1,32 @@
+"""sentence offsets
+
+Revision ID: a3c1f0d29b57
+Revises: 836a5f803c4d
+Create Date: 2023-05-02 10:12:41.118220
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a3c1f0d29b57'
+down_revision = '836a5f803c4d'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    try:
+        with op.batch_alter_table('paragraph', schema=None) as batch_op:
+            batch_op.add_column(sa.Column('sentence_offsets', sa.LargeBinary(), nullable=True))
+    except Exception as e:
+        print(e)
+
+
+def downgrade() -> None:
+    try:
+        with op.batch_alter_table('paragraph', schema=None) as batch_op:
+            batch_op.drop_column('sentence_offsets')
+    except Exception as e:
+        print(e)
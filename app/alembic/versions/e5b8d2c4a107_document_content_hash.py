@@ -0,0 +1,32 @@
+"""document content hash
+
+Revision ID: e5b8d2c4a107
+Revises: a3c1f0d29b57
+Create Date: 2023-05-04 14:37:12.804391
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e5b8d2c4a107'
+down_revision = 'a3c1f0d29b57'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    try:
+        with op.batch_alter_table('document', schema=None) as batch_op:
+            batch_op.add_column(sa.Column('content_hash', sa.String(length=40), nullable=True))
+    except Exception as e:
+        print(e)
+
+
+def downgrade() -> None:
+    try:
+        with op.batch_alter_table('document', schema=None) as batch_op:
+            batch_op.drop_column('content_hash')
+    except Exception as e:
+        print(e)
@@ -0,0 +1,202 @@
+import hashlib
+import logging
+import re
+import threading
+from datetime import datetime
+from typing import Dict, List, Tuple
+
+from sqlalchemy import func, update, bindparam
+from sqlalchemy.dialects.sqlite import insert
+
+from data_source.api.utils import get_utc_time_now
+from db_engine import Session
+from schemas import CachedAnswer, Paragraph, Document
+
+MAX_CACHED_ANSWERS = 100_000
+# hits are recorded in memory and written in the background once this many are pending, or before evicting
+MAX_PENDING_HITS = 1000
+# the cache is trimmed to MAX_CACHED_ANSWERS in the background once this many answers were put since the last time
+EVICTION_INTERVAL = 1000
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_query(query: str) -> str:
+    return ' '.join(re.findall(r'\w+', query.lower()))
+
+
+def content_hash(content: str) -> str:
+    return hashlib.sha1(content.encode()).hexdigest()
+
+
+class AnswerCache:
+    """
+    Persistent cache of the answer spans found by the QA model, keyed by (normalized query, paragraph).
+    Entries are checked against the paragraph content hash and removed when the paragraph is re-indexed.
+    """
+
+    _pending_hits: Dict[Tuple[str, int], datetime] = {}
+    _lock = threading.Lock()
+    _is_flushing = False
+    _puts_since_eviction = 0
+    _is_evicting = False
+
+    @staticmethod
+    def get(query: str, paragraphs: List[Tuple[int, str]]) -> Dict[int, Tuple[int, int]]:
+        """
+        Returns {paragraph_id: (answer_start, answer_end)} for the (paragraph_id, content) pairs that are cached
+        """
+        hashes = {paragraph_id: content_hash(content) for paragraph_id, content in paragraphs}
+        with Session() as session:
+            rows = session.query(CachedAnswer).filter(CachedAnswer.query == normalize_query(query),
+                                                      CachedAnswer.paragraph_id.in_(hashes.keys())).all()
+            hits = {row.paragraph_id: (row.answer_start, row.answer_end)
+                    for row in rows if row.content_hash == hashes[row.paragraph_id]}
+
+        if hits:
+            # searches only read the database, so they never wait on the indexer's write lock
+            AnswerCache._record_hits(normalize_query(query), hits.keys())
+        return hits
+
+    @staticmethod
+    def _record_hits(normalized_query: str, paragraph_ids):
+        now = get_utc_time_now()
+        with AnswerCache._lock:
+            for paragraph_id in paragraph_ids:
+                AnswerCache._pending_hits[(normalized_query, paragraph_id)] = now
+            should_flush = len(AnswerCache._pending_hits) >= MAX_PENDING_HITS and not AnswerCache._is_flushing
+            if should_flush:
+                AnswerCache._is_flushing = True
+
+        if should_flush:
+            threading.Thread(target=AnswerCache._flush_hits_in_background, daemon=True).start()
+
+    @staticmethod
+    def _flush_hits_in_background():
+        try:
+            with Session() as session:
+                AnswerCache._flush_hits(session)
+                session.commit()
+        except Exception as e:
+            logger.warning(f'Could not save the cached answers usage, will retry with the next hits: {e}')
+        finally:
+            with AnswerCache._lock:
+                AnswerCache._is_flushing = False
+
+    @staticmethod
+    def _flush_hits(session):
+        """
+        Writes the recorded hits, they are put back if writing them fails
+        """
+        with AnswerCache._lock:
+            pending_hits = AnswerCache._pending_hits
+            AnswerCache._pending_hits = {}
+        if len(pending_hits) == 0:
+            return
+
+        table = CachedAnswer.__table__
+        statement = update(table) \
+            .where(table.c.query == bindparam('hit_query'), table.c.paragraph_id == bindparam('hit_paragraph_id')) \
+            .values(last_used_at=bindparam('hit_last_used_at'))
+        try:
+            session.execute(statement, [dict(hit_query=query, hit_paragraph_id=paragraph_id, hit_last_used_at=used_at)
+                                        for (query, paragraph_id), used_at in pending_hits.items()])
+        except Exception:
+            AnswerCache._restore_hits(pending_hits)
+            raise
+
+    @staticmethod
+    def _restore_hits(pending_hits: Dict[Tuple[str, int], datetime]):
+        with AnswerCache._lock:
+            for key, used_at in pending_hits.items():
+                AnswerCache._pending_hits.setdefault(key, used_at)
+
+    @staticmethod
+    def put(query: str, answers: List[Tuple[int, str, int, int]]):
+        """
+        Stores (paragraph_id, content, answer_start, answer_end) tuples for the query
+        """
+        if len(answers) == 0:
+            return
+
+        now = get_utc_time_now()
+        values = [dict(query=normalize_query(query), paragraph_id=paragraph_id, content_hash=content_hash(content),
+                       answer_start=answer_start, answer_end=answer_end, last_used_at=now)
+                  for paragraph_id, content, answer_start, answer_end in answers]
+        statement = insert(CachedAnswer).values(values)
+        statement = statement.on_conflict_do_update(
+            index_elements=[CachedAnswer.query, CachedAnswer.paragraph_id],
+            set_={'content_hash': statement.excluded.content_hash,
+                  'answer_start': statement.excluded.answer_start,
+                  'answer_end': statement.excluded.answer_end,
+                  'last_used_at': statement.excluded.last_used_at})
+
+        with Session() as session:
+            session.execute(statement)
+            session.commit()
+
+        with AnswerCache._lock:
+            AnswerCache._puts_since_eviction += len(answers)
+            should_evict = AnswerCache._puts_since_eviction >= EVICTION_INTERVAL and not AnswerCache._is_evicting
+            if should_evict:
+                AnswerCache._puts_since_eviction = 0
+                AnswerCache._is_evicting = True
+
+        if should_evict:
+            # counting and deleting scan the whole cache, so searches don't wait for it
+            threading.Thread(target=AnswerCache._evict_in_background, daemon=True).start()
+
+    @staticmethod
+    def _evict_in_background():
+        try:
+            with Session() as session:
+                # before evicting, so recently hit answers aren't evicted as least recently used
+                AnswerCache._flush_hits(session)
+                AnswerCache._evict(session)
+                session.commit()
+        except Exception as e:
+            logger.warning(f'Could not evict cached answers, will retry after the next answers: {e}')
+        finally:
+            with AnswerCache._lock:
+                AnswerCache._is_evicting = False
+
+    @staticmethod
+    def _evict(session):
+        excess = session.query(func.count(CachedAnswer.id)).scalar() - MAX_CACHED_ANSWERS
+        if excess <= 0:
+            return
+
+        logger.info(f'Evicting {excess} least recently used cached answers')
+        oldest = session.query(CachedAnswer.id).order_by(CachedAnswer.last_used_at).limit(excess)
+        session.query(CachedAnswer).filter(CachedAnswer.id.in_(oldest.scalar_subquery())) \
+            .delete(synchronize_session=False)
+
+    @staticmethod
+    def _invalidate(paragraph_ids, session):
+        session.query(CachedAnswer).filter(CachedAnswer.paragraph_id.in_(paragraph_ids)) \
+            .delete(synchronize_session=False)
+
+    @staticmethod
+    def invalidate(paragraph_ids: List[int], session=None):
+        if session is None:
+            with Session() as session:
+                AnswerCache._invalidate(paragraph_ids, session)
+                session.commit()
+        else:
+            AnswerCache._invalidate(paragraph_ids, session)
+
+    @staticmethod
+    def invalidate_data_source(data_source_id: int, session=None):
+        if session is None:
+            with Session() as session:
+                AnswerCache.invalidate_data_source(data_source_id, session=session)
+                session.commit()
+            return
+
+        paragraph_ids = session.query(Paragraph.id).join(Document, Paragraph.document_id == Document.id) \
+            .filter(Document.data_source_id == data_source_id)
+        AnswerCache._invalidate(paragraph_ids.scalar_subquery(), session)
+
+    @staticmethod
+    def clear(session):
+        session.query(CachedAnswer).delete()
@@ -1,7 +1,14 @@
-from fastapi import APIRouter
+import json
+from datetime import datetime
+from typing import List, Optional
+
+from fastapi import APIRouter, Query
+from fastapi.encoders import jsonable_encoder
 from starlette.requests import Request
+from starlette.responses import StreamingResponse
 
-from search_logic import search_documents
+from data_source.api.basic_document import DocumentType
+from search_logic import search_documents, search_documents_progressively, SearchFilters
 from telemetry import Posthog
 
 router = APIRouter(
@@ -10,7 +17,37 @@ router = APIRouter(
 
 
 @router.get("")
-async def search(request: Request, query: str, top_k: int = 10):
+async def search(request: Request, query: str, top_k: int = 10,
+                 data_source: Optional[List[str]] = Query(None),
+                 document_type: Optional[List[DocumentType]] = Query(None),
+                 status: Optional[List[str]] = Query(None),
+                 after: Optional[datetime] = None,
+                 before: Optional[datetime] = None):
     uuid_header = request.headers.get('uuid')
     Posthog.increase_search_count(uuid=uuid_header)
-    return search_documents(query, top_k)
+    filters = SearchFilters(data_sources=data_source, types=document_type, statuses=status,
+                            after=after, before=before)
+    return search_documents(query, top_k, filters=filters)
+
+
+@router.get("/stream")
+async def search_stream(request: Request, query: str, top_k: int = 10,
+                        data_source: Optional[List[str]] = Query(None),
+                        document_type: Optional[List[DocumentType]] = Query(None),
+                        status: Optional[List[str]] = Query(None),
+                        after: Optional[datetime] = None,
+                        before: Optional[datetime] = None):
+    """
+    Server-Sent Events variant of the search, sends an event with the results after every ranking stage
+    ("preliminary", "refined" and "final").
+    """
+    uuid_header = request.headers.get('uuid')
+    Posthog.increase_search_count(uuid=uuid_header)
+    filters = SearchFilters(data_sources=data_source, types=document_type, statuses=status,
+                            after=after, before=before)
+
+    def events():
+        for stage, results in search_documents_progressively(query, top_k, filters=filters):
+            yield f"event: {stage.value}\ndata: {json.dumps(jsonable_encoder(results))}\n\n"
+
+    return StreamingResponse(events(), media_type="text/event-stream")
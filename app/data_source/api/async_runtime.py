@@ -0,0 +1,89 @@
+import asyncio
+import logging
+import os
+import threading
+from concurrent.futures import Future
+from typing import Coroutine, Dict, Optional
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+# connections kept per client, so a single data source can have this many requests in flight
+HTTP_MAX_CONNECTIONS = int(os.environ.get('ASYNC_HTTP_MAX_CONNECTIONS', 100))
+
+
+class AsyncRuntime:
+    """
+    Runs the tasks of async data sources on a single event loop in a background thread,
+    so their fetches are bounded by the rate limits instead of by the number of worker threads.
+    HTTP clients are pooled per key (usually the data source id) and keep their HTTP/2 connections alive.
+    """
+    _lock = threading.Lock()
+    _loop: Optional[asyncio.AbstractEventLoop] = None
+    _thread: Optional[threading.Thread] = None
+    _clients: Dict[str, httpx.AsyncClient] = {}
+
+    @classmethod
+    def _get_loop(cls) -> asyncio.AbstractEventLoop:
+        with cls._lock:
+            if cls._loop is None:
+                cls._loop = asyncio.new_event_loop()
+                cls._thread = threading.Thread(target=cls._loop.run_forever, name='async-runtime', daemon=True)
+                cls._thread.start()
+                logger.info('Async runtime started')
+            return cls._loop
+
+    @classmethod
+    def submit(cls, coroutine: Coroutine) -> Future:
+        """
+        Schedules the coroutine on the event loop, returns a future that can be waited on from any thread
+        """
+        return asyncio.run_coroutine_threadsafe(coroutine, cls._get_loop())
+
+    @classmethod
+    def run(cls, coroutine: Coroutine):
+        """
+        Runs the coroutine on the event loop and blocks the calling thread until it finishes
+        """
+        return cls.submit(coroutine).result()
+
+    @classmethod
+    def get_http_client(cls, key: str, **client_kwargs) -> httpx.AsyncClient:
+        """
+        Should only be called from the event loop, client_kwargs are only used when the client is created
+        """
+        client = cls._clients.get(key)
+        if client is None or client.is_closed:
+            limits = httpx.Limits(max_connections=HTTP_MAX_CONNECTIONS, max_keepalive_connections=HTTP_MAX_CONNECTIONS)
+            client = httpx.AsyncClient(http2=True, limits=limits, **client_kwargs)
+            cls._clients[key] = client
+        return client
+
+    @classmethod
+    async def _close_http_clients(cls):
+        clients = list(cls._clients.values())
+        cls._clients.clear()
+        for client in clients:
+            await client.aclose()
+
+    @classmethod
+    def close_http_client(cls, key: str):
+        client = cls._clients.pop(key, None)
+        if client is not None and cls._loop is not None:
+            cls.submit(client.aclose())
+
+    @classmethod
+    def stop(cls):
+        with cls._lock:
+            if cls._loop is None:
+                return
+            loop, thread = cls._loop, cls._thread
+            cls._loop = None
+            cls._thread = None
+
+        asyncio.run_coroutine_threadsafe(cls._close_http_clients(), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        loop.close()
+        logger.info('Async runtime stopped')
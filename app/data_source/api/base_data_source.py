@@ -1,20 +1,31 @@
+import asyncio
+import inspect
 import logging
 import re
+import time
 from abc import abstractmethod, ABC
-from datetime import datetime
+from contextvars import ContextVar
+from datetime import datetime, timezone
 from enum import Enum
-from typing import Dict, List, Optional, Callable
+from typing import Dict, List, Optional, Callable, Union, Awaitable
 
 from pydantic import BaseModel
+from sqlalchemy.dialects.sqlite import insert
 
+from data_source.api.async_runtime import AsyncRuntime
+from data_source.api.exception import RateLimitedException
+from data_source.api.rate_limiter import RateLimit, RateLimiter
 from data_source.api.utils import get_utc_time_now
 from db_engine import Session
-from queues.task_queue import TaskQueue, Task
-from schemas import DataSource
+from queues.task_queue import TaskQueue, Task, TaskPriority
+from schemas import DataSource, LocationCursor
 
 
 logger = logging.getLogger(__name__)
 
+# priority of the tasks added from the current thread or asyncio task, tasks added while running a task inherit its priority
+_task_priority: ContextVar[TaskPriority] = ContextVar('task_priority', default=TaskPriority.INCREMENTAL)
+
 
 class Location(BaseModel):
     value: str
@@ -49,6 +60,8 @@ class ConfigField(BaseModel):
 
 
 class BaseDataSource(ABC):
+    # limits shared by all the tasks of a data source, see RateLimiter
+    RATE_LIMIT = RateLimit()
 
     @staticmethod
     @abstractmethod
@@ -96,9 +109,11 @@ class BaseDataSource(ABC):
         return []
 
     @abstractmethod
-    def _feed_new_documents(self) -> None:
+    def _feed_new_documents(self) -> Union[None, Awaitable[None]]:
         """
         Feeds the indexing queue with new documents.
+        Data sources may implement it, and their task functions, as coroutines. Those run on the AsyncRuntime
+        event loop, and should fetch through self._get_http_client() instead of blocking.
         """
         raise NotImplementedError
 
@@ -124,16 +139,117 @@ class BaseDataSource(ABC):
             data_source.last_indexed_at = get_utc_time_now()
             session.commit()
 
+    def _get_location_cursor(self, location: str) -> Optional[str]:
+        """
+        Returns the high-water mark saved by the last completed task of the location, None if there is none
+        """
+        with Session() as session:
+            location_cursor = session.query(LocationCursor).filter_by(data_source_id=self._data_source_id,
+                                                                      location=location).first()
+            return location_cursor.cursor if location_cursor is not None else None
+
+    def _save_location_cursor(self, location: str, cursor: str) -> None:
+        """
+        Should be called once everything up to the cursor was fed, so the next sync only fetches what comes after it
+        """
+        with Session() as session:
+            statement = insert(LocationCursor).values(data_source_id=self._data_source_id, location=location,
+                                                      cursor=cursor, updated_at=get_utc_time_now())
+            statement = statement.on_conflict_do_update(
+                index_elements=[LocationCursor.data_source_id, LocationCursor.location],
+                set_={'cursor': statement.excluded.cursor, 'updated_at': statement.excluded.updated_at})
+            session.execute(statement)
+            session.commit()
+
+    def _delete_location_cursor(self, location: str) -> None:
+        with Session() as session:
+            session.query(LocationCursor).filter_by(data_source_id=self._data_source_id, location=location).delete()
+            session.commit()
+
+    def _get_location_index_time(self, location: str) -> datetime:
+        """
+        For connectors whose cursor is a timestamp, falls back to the data source index time
+        for locations indexed before cursors were saved
+        """
+        cursor = self._get_location_cursor(location)
+        if cursor is None:
+            return self._last_index_time
+        index_time = datetime.fromisoformat(cursor)
+        if index_time.tzinfo is not None:
+            # same convention as last_indexed_at
+            index_time = index_time.astimezone(timezone.utc).replace(tzinfo=None)
+        return index_time
+
+    def _is_first_index(self) -> bool:
+        with Session() as session:
+            data_source: DataSource = session.query(DataSource).filter_by(id=self._data_source_id).first()
+            return data_source.last_indexed_at is None
+
     def add_task_to_queue(self, function: Callable, **kwargs):
         task = Task(data_source_id=self._data_source_id,
                     function_name=function.__name__,
-                    kwargs=kwargs)
+                    kwargs=kwargs,
+                    priority=_task_priority.get())
         TaskQueue.get_instance().add_task(task)
 
-    def run_task(self, function_name: str, **kwargs) -> None:
+    def _take_request_token(self) -> None:
+        """
+        Waits until the data source may send a request, for data sources whose RATE_LIMIT is per_request
+        """
+        while (wait := RateLimiter.reserve_request(self._data_source_id, self.RATE_LIMIT)) > 0:
+            time.sleep(wait)
+
+    async def _take_request_token_async(self) -> None:
+        while (wait := RateLimiter.reserve_request(self._data_source_id, self.RATE_LIMIT)) > 0:
+            await asyncio.sleep(wait)
+
+    def _meter_requests(self, client, method_name: str = 'request') -> None:
+        """
+        Takes a request token before every call of the client's method that sends the requests,
+        for clients whose requests are made inside a library (e.g. a requests.Session)
+        """
+        send = getattr(client, method_name)
+
+        def metered_send(*args, **kwargs):
+            self._take_request_token()
+            return send(*args, **kwargs)
+
+        setattr(client, method_name, metered_send)
+
+    def _get_http_client(self, **client_kwargs):
+        """
+        The pooled HTTP client of this data source, for async data sources
+        """
+        return AsyncRuntime.get_http_client(str(self._data_source_id), **client_kwargs)
+
+    def is_async_task(self, function_name: str) -> bool:
+        return inspect.iscoroutinefunction(getattr(self, function_name))
+
+    def run_task(self, function_name: str, task_priority: TaskPriority = TaskPriority.INCREMENTAL, **kwargs) -> None:
+        if self.is_async_task(function_name):
+            # sync adapter, the workers submit async tasks with run_task_async instead of blocking on them
+            AsyncRuntime.run(self.run_task_async(function_name, task_priority, **kwargs))
+            return
+
         self._last_task_time = get_utc_time_now()
         function = getattr(self, function_name)
-        function(**kwargs)
+        token = _task_priority.set(task_priority)
+        try:
+            function(**kwargs)
+        finally:
+            _task_priority.reset(token)
+
+    async def run_task_async(self, function_name: str, task_priority: TaskPriority = TaskPriority.INCREMENTAL,
+                             **kwargs) -> None:
+        self._last_task_time = get_utc_time_now()
+        function = getattr(self, function_name)
+        # every asyncio task has its own context, so this doesn't leak into concurrent tasks
+        _task_priority.set(task_priority)
+        await function(**kwargs)
+
+    async def _feed_new_documents_async(self, priority: TaskPriority):
+        _task_priority.set(priority)
+        await self._feed_new_documents()
 
     def index(self, force: bool = False) -> None:
         if self._last_task_time is not None and not force:
@@ -143,11 +259,32 @@ class BaseDataSource(ABC):
                 logging.info("Skipping indexing data source because it was indexed recently")
                 return
 
+        token = None
         try:
+            if self._is_first_index():
+                priority = TaskPriority.BACKFILL
+            elif force:
+                priority = TaskPriority.INTERACTIVE
+            else:
+                priority = TaskPriority.INCREMENTAL
+
+            token = _task_priority.set(priority)
             self._save_index_time_in_db()
-            self._feed_new_documents()
+            if inspect.iscoroutinefunction(self._feed_new_documents):
+                AsyncRuntime.run(self._feed_new_documents_async(priority))
+            else:
+                self._feed_new_documents()
+        except RateLimitedException as e:
+            # the workers feed it again once the pause is over, instead of waiting for the next sync
+            logging.warning(f"Data source {self._data_source_id} was rate limited while listing, "
+                            f"feeding it again in {e.retry_after} seconds")
+            RateLimiter.throttle(self._data_source_id, e.retry_after, self.RATE_LIMIT)
+            self.add_task_to_queue(self._feed_new_documents)
         except Exception as e:
             logging.exception("Error while indexing data source")
+        finally:
+            if token is not None:
+                _task_priority.reset(token)
 
     def _is_prior_to_last_index_time(self, doc_time: datetime) -> bool:
         if doc_time.tzinfo is not None and self._last_index_time.tzinfo is None:
@@ -6,9 +6,11 @@ from typing import Dict, List
 from pydantic import ValidationError
 from sqlalchemy import select
 
+from data_source.api.async_runtime import AsyncRuntime
 from data_source.api.base_data_source import BaseDataSource
 from data_source.api.dynamic_loader import DynamicLoader, ClassInfo
 from data_source.api.exception import KnownException
+from data_source.api.rate_limiter import RateLimiter
 from data_source.api.utils import get_utc_time_now
 from db_engine import Session, async_session
 from schemas import DataSourceType, DataSource, Document
@@ -95,6 +97,8 @@ class DataSourceContext:
             session.commit()
 
             del cls._data_source_cache[data_source_id]
+            RateLimiter.remove(data_source_id)
+            AsyncRuntime.close_http_client(str(data_source_id))
 
             return data_source_name
 
@@ -6,3 +6,12 @@ class KnownException(Exception):
 
 class InvalidDataSourceConfig(Exception):
     pass
+
+
+class RateLimitedException(Exception):
+    """
+    Raised by a data source when its API answered 429, the task is retried once retry_after seconds passed
+    """
+    def __init__(self, retry_after: float):
+        self.retry_after = retry_after
+        super().__init__(f"Rate limited, retry after {retry_after} seconds")
@@ -0,0 +1,130 @@
+import logging
+import threading
+import time
+from dataclasses import dataclass
+from typing import Dict, Optional, Set
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class RateLimit:
+    """
+    Limits of a data source type, set as the RATE_LIMIT of its class.
+    Connectors that take a token before every request they send set per_request, so tokens_per_second bounds
+    their requests. Otherwise a token is taken per task, and it bounds how fast their tasks are started.
+    """
+    max_concurrency: int = 8
+    tokens_per_second: float = 10
+    burst: int = 20
+    per_request: bool = False
+
+
+class _DataSourceLimiter:
+    # after a 429 the rate is halved, and every finished task grows it back by this fraction of the configured rate
+    RECOVERY_STEP = 0.05
+
+    def __init__(self, rate_limit: RateLimit):
+        self.rate_limit = rate_limit
+        self.rate = rate_limit.tokens_per_second
+        self.tokens = float(rate_limit.burst)
+        self.last_refill = time.monotonic()
+        self.blocked_until = 0.0
+        self.in_flight = 0
+
+    def _refill(self, now: float):
+        self.tokens = min(self.rate_limit.burst, self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+
+    def is_available(self, now: float) -> bool:
+        self._refill(now)
+        return now >= self.blocked_until and self.in_flight < self.rate_limit.max_concurrency and self.tokens >= 1
+
+    def acquire(self, now: float) -> bool:
+        if not self.is_available(now):
+            return False
+        if not self.rate_limit.per_request:
+            self.tokens -= 1
+        self.in_flight += 1
+        return True
+
+    def reserve(self, now: float) -> float:
+        """
+        Takes a token for a request, returns how long to wait before trying again if there is none
+        """
+        self._refill(now)
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        if self.tokens < 1:
+            return (1 - self.tokens) / self.rate
+        self.tokens -= 1
+        return 0
+
+    def release(self):
+        self.in_flight -= 1
+        self.rate = min(self.rate_limit.tokens_per_second,
+                        self.rate + self.rate_limit.tokens_per_second * self.RECOVERY_STEP)
+
+    def throttle(self, now: float, retry_after: float):
+        self.blocked_until = max(self.blocked_until, now + retry_after)
+        self.rate = max(self.rate_limit.tokens_per_second * self.RECOVERY_STEP, self.rate / 2)
+        self.tokens = 0
+
+
+class RateLimiter:
+    """
+    Shared by the workers, decides which data sources may start a task now.
+    Workers skip data sources that are throttled instead of sleeping on them,
+    connectors metering their requests wait for a token in the task instead.
+    """
+    _lock = threading.Lock()
+    _limiters: Dict[int, _DataSourceLimiter] = {}
+
+    @classmethod
+    def _get_limiter(cls, data_source_id: int, rate_limit: RateLimit) -> _DataSourceLimiter:
+        limiter = cls._limiters.get(data_source_id)
+        if limiter is None:
+            limiter = cls._limiters[data_source_id] = _DataSourceLimiter(rate_limit)
+        return limiter
+
+    @classmethod
+    def try_acquire(cls, data_source_id: int, rate_limit: RateLimit) -> bool:
+        with cls._lock:
+            return cls._get_limiter(data_source_id, rate_limit).acquire(time.monotonic())
+
+    @classmethod
+    def reserve_request(cls, data_source_id: int, rate_limit: RateLimit) -> float:
+        with cls._lock:
+            return cls._get_limiter(data_source_id, rate_limit).reserve(time.monotonic())
+
+    @classmethod
+    def release(cls, data_source_id: int):
+        with cls._lock:
+            if limiter := cls._limiters.get(data_source_id):
+                limiter.release()
+
+    @classmethod
+    def throttle(cls, data_source_id: int, retry_after: float, rate_limit: Optional[RateLimit] = None):
+        """
+        rate_limit is needed to pause a data source that didn't take a slot or a token yet
+        """
+        logger.warning(f'Data source {data_source_id} is rate limited, pausing it for {retry_after} seconds')
+        with cls._lock:
+            if rate_limit is not None:
+                limiter = cls._get_limiter(data_source_id, rate_limit)
+            else:
+                limiter = cls._limiters.get(data_source_id)
+            if limiter is not None:
+                limiter.throttle(time.monotonic(), retry_after)
+
+    @classmethod
+    def get_unavailable_data_sources(cls) -> Set[int]:
+        with cls._lock:
+            now = time.monotonic()
+            return {data_source_id for data_source_id, limiter in cls._limiters.items()
+                    if not limiter.is_available(now)}
+
+    @classmethod
+    def remove(cls, data_source_id: int):
+        with cls._lock:
+            cls._limiters.pop(data_source_id, None)
@@ -1,7 +1,6 @@
 import logging
 import os
 from datetime import datetime
-from time import sleep
 from typing import List, Dict
 from urllib.parse import urljoin
 
@@ -11,7 +10,8 @@ from requests.auth import AuthBase
 
 from data_source.api.base_data_source import BaseDataSource, ConfigField, HTMLInputType, BaseDataSourceConfig
 from data_source.api.basic_document import BasicDocument, DocumentType
-from data_source.api.exception import InvalidDataSourceConfig
+from data_source.api.exception import InvalidDataSourceConfig, RateLimitedException
+from data_source.api.rate_limiter import RateLimit
 from parsers.html import html_to_text
 from queues.index_queue import IndexQueue
 
@@ -36,24 +36,15 @@ class BookStack(Session):
         super().__init__(*args, **kwargs)
         self.base_url = url
         self.auth = BookStackAuth(token_id, token_secret)
-        self.rate_limit_reach = False
 
     def request(self, method, url_path, *args, **kwargs):
-        while self.rate_limit_reach:
-            sleep(1)
-
         url = urljoin(self.base_url, url_path)
         r = super().request(method, url, verify=BookStack.VERIFY_SSL, *args, **kwargs)
 
         if r.status_code != 200:
             if r.status_code == 429:
-                if not self.rate_limit_reach:
-                    logger.info("API rate limit reach, waiting...")
-                    self.rate_limit_reach = True
-                    sleep(60)
-                    self.rate_limit_reach = False
-                    logger.info("Done waiting for the API rate limit")
-                return self.request(method, url, verify=BookStack.VERIFY_SSL, *args, **kwargs)
+                # the workers pause this data source and retry the task
+                raise RateLimitedException(retry_after=float(r.headers.get('Retry-After', 60)))
             r.raise_for_status()
         return r
 
@@ -107,6 +98,9 @@ class BookStackConfig(BaseDataSourceConfig):
 
 
 class BookstackDataSource(BaseDataSource):
+    # BookStack allows 180 requests a minute
+    RATE_LIMIT = RateLimit(max_concurrency=4, tokens_per_second=3, burst=10, per_request=True)
+
     @staticmethod
     def get_config_fields() -> List[ConfigField]:
         return [
@@ -126,6 +120,8 @@ class BookstackDataSource(BaseDataSource):
         for i in range(retries):
             try:
                 return book_stack.get_all_books()
+            except RateLimitedException as e:
+                raise e
             except Exception as e:
                 logging.error(f"BookStack connection failed: {e}")
                 if i == retries - 1:
@@ -146,6 +142,7 @@ class BookstackDataSource(BaseDataSource):
         book_stack_config = BookStackConfig(**self._raw_config)
         self._book_stack = BookStack(url=book_stack_config.url, token_id=book_stack_config.token_id,
                                      token_secret=book_stack_config.token_secret)
+        self._meter_requests(self._book_stack)
 
     def _list_books(self) -> List[Dict]:
         logger.info("Listing books with BookStack")
@@ -1,7 +1,9 @@
+import json
 import logging
 import os
 import dateutil.parser
-from typing import List, Dict
+from datetime import datetime
+from typing import List, Dict, Optional
 
 from atlassian import Confluence
 from atlassian.errors import ApiError
@@ -10,6 +12,7 @@ from requests import HTTPError
 from data_source.api.base_data_source import BaseDataSource, ConfigField, HTMLInputType, Location, BaseDataSourceConfig
 from data_source.api.basic_document import BasicDocument, DocumentType
 from data_source.api.exception import InvalidDataSourceConfig
+from data_source.api.rate_limiter import RateLimit
 from parsers.html import html_to_text
 from queues.index_queue import IndexQueue
 
@@ -22,6 +25,8 @@ class ConfluenceConfig(BaseDataSourceConfig):
 
 
 class ConfluenceDataSource(BaseDataSource):
+    # every space is crawled by its own task, so this also bounds how many spaces are crawled in parallel
+    RATE_LIMIT = RateLimit(max_concurrency=int(os.environ.get('CONFLUENCE_MAX_CONCURRENCY', 8)), per_request=True)
 
     @staticmethod
     def get_config_fields() -> List[ConfigField]:
@@ -35,31 +40,42 @@ class ConfluenceDataSource(BaseDataSource):
         return "Confluence Self-Hosted"
 
     @staticmethod
-    def list_spaces(confluence: Confluence, start=0) -> List[Location]:
+    def _get_spaces_page(confluence: Confluence, start=0, next_link: Optional[str] = None) -> Dict:
         # Usually the confluence connection fails, so we retry a few times
         retries = 3
         for i in range(retries):
             try:
-                return [Location(label=space['name'], value=space['key'])
-                        for space in confluence.get_all_spaces(expand='status', start=start)['results']]
+                if next_link is not None:
+                    return confluence.get(next_link)
+                return confluence.get_all_spaces(expand='status', start=start)
             except Exception as e:
                 logging.error(f'Confluence connection failed: {e}')
                 if i == retries - 1:
                     raise e
 
+    @staticmethod
+    def _to_locations(spaces_page: Dict) -> List[Location]:
+        return [Location(label=space['name'], value=space['key']) for space in spaces_page['results']]
+
+    @staticmethod
+    def list_spaces(confluence: Confluence, start=0) -> List[Location]:
+        return ConfluenceDataSource._to_locations(ConfluenceDataSource._get_spaces_page(confluence, start=start))
+
     @staticmethod
     def list_all_spaces(confluence: Confluence) -> List[Location]:
         logger.info('Listing spaces')
 
         spaces = []
-        start = 0
+        spaces_page = ConfluenceDataSource._get_spaces_page(confluence)
         while True:
-            new_spaces = ConfluenceDataSource.list_spaces(confluence=confluence, start=start)
-            if len(new_spaces) == 0:
-                break
-
+            new_spaces = ConfluenceDataSource._to_locations(spaces_page)
             spaces.extend(new_spaces)
-            start += len(new_spaces)
+
+            # follow the next links, Confluence Cloud doesn't support deep offsets
+            next_link = spaces_page.get('_links', {}).get('next')
+            if len(new_spaces) == 0 or next_link is None:
+                break
+            spaces_page = ConfluenceDataSource._get_spaces_page(confluence, next_link=next_link)
 
         logger.info(f'Found {len(spaces)} spaces')
         return spaces
@@ -89,7 +105,8 @@ class ConfluenceDataSource(BaseDataSource):
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self._confluence = ConfluenceDataSource.confluence_client_from_config(self._raw_config)
+        self._confluence = self.confluence_client_from_config(self._raw_config)
+        self._meter_requests(self._confluence.session)
 
     def _list_spaces(self) -> List[Location]:
         return ConfluenceDataSource.list_all_spaces(confluence=self._confluence)
@@ -100,28 +117,108 @@ class ConfluenceDataSource(BaseDataSource):
         for space in spaces:
             self.add_task_to_queue(self._feed_space_docs, space=space)
 
+    @staticmethod
+    def _position_key(space: Location) -> str:
+        return f'{space.value}#position'
+
+    def _search_space(self, cql_query: str, next_link: Optional[str]) -> Dict:
+        if next_link is not None:
+            return self._confluence.get(next_link)
+        return self._confluence.cql(cql_query, start=0, limit=50, expand='content.body.storage,content.history')
+
     def _feed_space_docs(self, space: Location) -> List[Dict]:
         logging.info(f'Getting documents from space {space.label} ({space.value})')
-        start = 0
-        limit = 200  # limit when expanding the version
 
-        last_index_time = self._last_index_time.strftime("%Y-%m-%d %H:%M")
+        last_index_time = self._get_location_index_time(space.value).strftime("%Y-%m-%d %H:%M")
         cql_query = f'type = page AND Space = "{space.value}" AND lastModified >= "{last_index_time}" ' \
                     f'ORDER BY lastModified DESC'
         logger.info(f'Querying confluence with CQL: {cql_query}')
+
+        # an interrupted crawl of the space continues from the page it reached
+        next_link = None
+        high_water_mark = None
+        # the oldest page fed by its own task, the cursor stays before it in case that task fails
+        oldest_fallback = None
+        if position := self._get_location_cursor(self._position_key(space)):
+            position = json.loads(position)
+            next_link = position['next']
+            high_water_mark = dateutil.parser.parse(position['high_water_mark'])
+            if position.get('oldest_fallback'):
+                oldest_fallback = dateutil.parser.parse(position['oldest_fallback'])
+            logger.info(f'Resuming space {space.label} from {next_link}')
+
+        total = 0
         while True:
-            new_batch = self._confluence.cql(cql_query, start=start, limit=limit,
-                                             expand='version')['results']
-            len_new_batch = len(new_batch)
-            logger.info(f'Got {len_new_batch} documents from space {space.label} (total {start + len_new_batch})')
+            try:
+                response = self._search_space(cql_query, next_link)
+            except (HTTPError, ApiError) as e:
+                if next_link is None or total > 0:
+                    raise e
+                logger.warning(f'Could not resume space {space.label} ({e}), starting over')
+                next_link = None
+                high_water_mark = None
+                oldest_fallback = None
+                continue
+
+            new_batch = response['results']
+            base_url = response.get('_links', {}).get('base') or self._raw_config['url']
+            total += len(new_batch)
+            logger.info(f'Got {len(new_batch)} documents from space {space.label} (total {total})')
+
+            docs = []
             for raw_doc in new_batch:
                 raw_doc['space_name'] = space.label
-                self.add_task_to_queue(self._feed_doc, raw_doc=raw_doc)
-
-            if len(new_batch) < limit:
+                last_modified = dateutil.parser.parse(raw_doc['lastModified'])
+                if high_water_mark is None or last_modified > high_water_mark:
+                    high_water_mark = last_modified
+
+                try:
+                    docs.append(self._page_to_document(raw_doc['content'], base_url=base_url,
+                                                       last_modified=last_modified, space_name=space.label))
+                except KeyError:
+                    # the body or history couldn't be expanded, fetch the page on its own
+                    self.add_task_to_queue(self._feed_doc, raw_doc=raw_doc)
+                    if oldest_fallback is None or last_modified < oldest_fallback:
+                        oldest_fallback = last_modified
+            if docs:
+                IndexQueue.get_instance().put(docs=docs)
+
+            # cursor pagination, Confluence Cloud doesn't support deep offsets and caps expanded pages
+            next_link = response.get('_links', {}).get('next')
+            if len(new_batch) == 0 or next_link is None:
                 break
 
-            start += limit
+            self._save_location_cursor(self._position_key(space), json.dumps({
+                'next': next_link, 'high_water_mark': high_water_mark.isoformat(),
+                'oldest_fallback': oldest_fallback.isoformat() if oldest_fallback is not None else None}))
+
+        if oldest_fallback is not None:
+            # the next sync lists the page again (lastModified >= cursor), the pages after it are skipped as unchanged
+            high_water_mark = min(high_water_mark, oldest_fallback)
+        if high_water_mark is not None:
+            self._save_location_cursor(space.value, high_water_mark.isoformat())
+        self._delete_location_cursor(self._position_key(space))
+
+    def _page_to_document(self, raw_page: Dict, base_url: str, last_modified: datetime,
+                          space_name: str) -> BasicDocument:
+        author = raw_page['history']['createdBy']['displayName']
+        author_image = raw_page['history']['createdBy']['profilePicture']['path']
+        author_image_url = base_url + author_image
+        html_content = raw_page['body']['storage']['value']
+        plain_text = html_to_text(html_content)
+
+        url = base_url + raw_page['_links']['webui']
+
+        return BasicDocument(title=raw_page['title'],
+                             content=plain_text,
+                             author=author,
+                             author_image_url=author_image_url,
+                             timestamp=last_modified,
+                             id=raw_page['id'],
+                             data_source_id=self._data_source_id,
+                             location=space_name,
+                             url=url,
+                             type=DocumentType.DOCUMENT)
 
     def _feed_doc(self, raw_doc: Dict):
         last_modified = dateutil.parser.parse(raw_doc['lastModified'])
@@ -137,24 +234,8 @@ class ConfluenceDataSource(BaseDataSource):
                 f'unable to access document {doc_id} ({raw_doc["title"]}). reason: "{e.reason}". skipping.')
             return
 
-        author = fetched_raw_page['history']['createdBy']['displayName']
-        author_image = fetched_raw_page['history']['createdBy']['profilePicture']['path']
-        author_image_url = fetched_raw_page['_links']['base'] + author_image
-        html_content = fetched_raw_page['body']['storage']['value']
-        plain_text = html_to_text(html_content)
-
-        url = fetched_raw_page['_links']['base'] + fetched_raw_page['_links']['webui']
-
-        doc = BasicDocument(title=fetched_raw_page['title'],
-                            content=plain_text,
-                            author=author,
-                            author_image_url=author_image_url,
-                            timestamp=last_modified,
-                            id=doc_id,
-                            data_source_id=self._data_source_id,
-                            location=raw_doc['space_name'],
-                            url=url,
-                            type=DocumentType.DOCUMENT)
+        doc = self._page_to_document(fetched_raw_page, base_url=fetched_raw_page['_links']['base'],
+                                     last_modified=last_modified, space_name=raw_doc['space_name'])
         IndexQueue.get_instance().put_single(doc=doc)
 
 # if __name__ == '__main__':
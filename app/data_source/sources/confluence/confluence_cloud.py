@@ -46,10 +46,6 @@ class ConfluenceCloudDataSource(ConfluenceDataSource):
         confluence = ConfluenceCloudDataSource.confluence_client_from_config(config)
         return ConfluenceDataSource.list_all_spaces(confluence=confluence)
 
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        self._confluence = ConfluenceCloudDataSource.confluence_client_from_config(self._raw_config)
-
 
 # if __name__ == '__main__':
 #     import os
@@ -1,17 +1,26 @@
+import asyncio
 import logging
+import os
+from datetime import datetime, timezone
 
-import requests
-from typing import Dict, List, Optional
+import httpx
+from typing import AsyncIterator, Callable, Dict, List, Optional, Union
 import dateutil.parser
 
 from data_source.api.base_data_source import BaseDataSource, BaseDataSourceConfig, ConfigField, HTMLInputType
 from data_source.api.basic_document import BasicDocument, DocumentType, DocumentStatus
-from data_source.api.exception import InvalidDataSourceConfig
+from data_source.api.exception import InvalidDataSourceConfig, RateLimitedException
+from data_source.api.rate_limiter import RateLimit
 from queues.index_queue import IndexQueue
 
 
 logger = logging.getLogger(__name__)
 
+PER_PAGE = 100
+# requests a data source has in flight at once, shared by the pages and notes of all its tasks
+MAX_CONCURRENCY = int(os.environ.get('GITLAB_MAX_CONCURRENCY', 8))
+MAX_ATTEMPTS = 4
+
 
 class GitlabConfig(BaseDataSourceConfig):
     url: str
@@ -21,7 +30,7 @@ class GitlabConfig(BaseDataSourceConfig):
 def gitlab_status_to_doc_status(status: str) -> Optional[DocumentStatus]:
     if status == "opened":
         return DocumentStatus.OPEN
-    elif status == "closed":
+    elif status in ("closed", "merged", "locked"):
         return DocumentStatus.CLOSED
     else:
         logger.warning(f"[!] Unknown status {status}")
@@ -29,6 +38,7 @@ def gitlab_status_to_doc_status(status: str) -> Optional[DocumentStatus]:
 
 
 class GitlabDataSource(BaseDataSource):
+    RATE_LIMIT = RateLimit(per_request=True)
 
     @staticmethod
     def get_config_fields() -> List[ConfigField]:
@@ -42,100 +52,180 @@ class GitlabDataSource(BaseDataSource):
     async def validate_config(config: Dict) -> None:
         try:
             parsed_config = GitlabConfig(**config)
-            session = requests.Session()
-            session.headers.update({"PRIVATE-TOKEN": parsed_config.access_token})
-            projects_response = session.get(f"{parsed_config.url}/api/v4/projects?membership=true")
-            projects_response.raise_for_status()
+            async with httpx.AsyncClient(headers={"PRIVATE-TOKEN": parsed_config.access_token}) as client:
+                projects_response = await client.get(f"{parsed_config.url}/api/v4/projects",
+                                                     params={"membership": "true", "per_page": 1})
+                projects_response.raise_for_status()
         except (KeyError, ValueError) as e:
             raise InvalidDataSourceConfig from e
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.gitlab_config = GitlabConfig(**self._raw_config)
-        self._session = requests.Session()
-        self._session.headers.update({"PRIVATE-TOKEN": self.gitlab_config.access_token})
-
-    def _get_all_paginated(self, url: str) -> List[Dict]:
-        items = []
-        page = 1
-        per_page = 100
-
-        while True:
+        self._semaphore: Optional[asyncio.Semaphore] = None
+
+    async def _get(self, path: str, params: Dict) -> httpx.Response:
+        """
+        Retries network errors and server errors a bounded number of times, then fails the task
+        """
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(MAX_CONCURRENCY)
+        client = self._get_http_client(base_url=f"{self.gitlab_config.url}/api/v4",
+                                       headers={"PRIVATE-TOKEN": self.gitlab_config.access_token},
+                                       timeout=30)
+
+        for attempt in range(1, MAX_ATTEMPTS + 1):
             try:
-                response = self._session.get(url + f"&per_page={per_page}&page={page}")
+                await self._take_request_token_async()
+                async with self._semaphore:
+                    response = await client.get(path, params=params)
+                if response.status_code == 429:
+                    # the workers pause this data source and retry the task
+                    raise RateLimitedException(retry_after=float(response.headers.get('Retry-After', 60)))
                 response.raise_for_status()
-                new_items: List[Dict] = response.json()
-                items.extend(new_items)
-
-                if len(new_items) < per_page:
-                    break
+                return response
+            except (httpx.TransportError, httpx.HTTPStatusError) as e:
+                is_server_error = isinstance(e, httpx.HTTPStatusError) and e.response.status_code >= 500
+                if attempt == MAX_ATTEMPTS or not (isinstance(e, httpx.TransportError) or is_server_error):
+                    raise
+                logger.warning(f"Error while fetching {path} (attempt {attempt}/{MAX_ATTEMPTS}): {e}")
+                await asyncio.sleep(2 ** attempt)
+
+    async def _iter_pages(self, path: str, params: Optional[Dict] = None) -> AsyncIterator[List[Dict]]:
+        """
+        Yields the pages in order. Once the first page tells how many pages there are, the rest are fetched
+        MAX_CONCURRENCY at a time. GitLab doesn't count more than 10,000 items, those are followed page by page.
+        """
+        params = {**(params or {}), "per_page": PER_PAGE}
+        first_page = await self._get(path, {**params, "page": 1})
+        yield first_page.json()
+
+        if total_pages := first_page.headers.get("X-Total-Pages"):
+            pages = range(2, int(total_pages) + 1)
+            for window_start in range(0, len(pages), MAX_CONCURRENCY):
+                window = pages[window_start:window_start + MAX_CONCURRENCY]
+                responses = await asyncio.gather(*[self._get(path, {**params, "page": page}) for page in window])
+                for response in responses:
+                    yield response.json()
+            return
 
-                page += 1
-            except:
-                logging.exception("Error while fetching items paginated for url: " + url)
+        next_page = first_page.headers.get("X-Next-Page")
+        while next_page:
+            response = await self._get(path, {**params, "page": next_page})
+            yield response.json()
+            next_page = response.headers.get("X-Next-Page")
 
+    async def _get_all_paginated(self, path: str, params: Optional[Dict] = None) -> List[Dict]:
+        items = []
+        async for page in self._iter_pages(path, params):
+            items.extend(page)
         return items
 
-    def _list_all_projects(self) -> List[Dict]:
-        return self._get_all_paginated(f"{self.gitlab_config.url}/api/v4/projects?membership=true")
+    async def _list_all_projects(self) -> List[Dict]:
+        return await self._get_all_paginated("/projects", {"membership": "true", "simple": "true"})
 
-    def _feed_new_documents(self) -> None:
-        for project in self._list_all_projects():
+    async def _feed_new_documents(self) -> None:
+        for project in await self._list_all_projects():
             logger.info(f"Feeding project {project['name']}")
             self.add_task_to_queue(self._feed_project_issues, project=project)
-
-    def _feed_project_issues(self, project: Dict):
-        project_id = project["id"]
-        issues_url = f"{self.gitlab_config.url}/api/v4/projects/{project_id}/issues?scope=all"
-        all_issues = self._get_all_paginated(issues_url)
-
-        for issue in all_issues:
-            self.add_task_to_queue(self.feed_issue, issue=issue)
-
-    def feed_issue(self, issue: Dict):
-        updated_at = dateutil.parser.parse(issue["updated_at"])
-        if self._is_prior_to_last_index_time(doc_time=updated_at):
-            logger.info(f"Issue {issue['id']} is too old, skipping")
-            return
-
-        comments_url = \
-            f"{self.gitlab_config.url}/api/v4/projects/{issue['project_id']}/issues/{issue['iid']}/notes?sort=asc"
-        raw_comments = self._get_all_paginated(comments_url)
+            self.add_task_to_queue(self._feed_project_merge_requests, project=project)
+
+    async def _feed_project_issues(self, project: Dict):
+        await self._feed_project_noteables(project, "issues", self._issue_to_document)
+
+    async def _feed_project_merge_requests(self, project: Dict):
+        await self._feed_project_noteables(project, "merge_requests", self._merge_request_to_document)
+
+    async def _feed_project_noteables(self, project: Dict, noteable_type: str,
+                                      to_document: Callable[[Dict, List[Dict]], BasicDocument]):
+        """
+        Feeds the issues or merge requests updated since the last sync of the project, a batch per page
+        """
+        location = f"{project['id']}/{noteable_type}"
+        updated_after = self._get_location_index_time(location)
+        if updated_after.tzinfo is None:
+            updated_after = updated_after.replace(tzinfo=timezone.utc)
+        # newest first, an item updated while paginating moves to a page already fetched and shifts the rest
+        # one place further, so items may be fetched twice (and skipped as unchanged) but none is missed
+        params = {"scope": "all", "updated_after": updated_after.isoformat(),
+                  "order_by": "updated_at", "sort": "desc"}
+
+        high_water_mark: Optional[datetime] = None
+        async for page in self._iter_pages(f"/projects/{project['id']}/{noteable_type}", params):
+            notes = await asyncio.gather(*[self._get_notes(noteable_type, item) for item in page])
+            docs = [to_document(item, item_notes) for item, item_notes in zip(page, notes)]
+            if docs:
+                IndexQueue.get_instance().put(docs=docs)
+
+            for item in page:
+                updated_at = dateutil.parser.parse(item["updated_at"])
+                if high_water_mark is None or updated_at > high_water_mark:
+                    high_water_mark = updated_at
+
+        if high_water_mark is not None:
+            self._save_location_cursor(location, high_water_mark.isoformat())
+
+    async def _get_notes(self, noteable_type: str, noteable: Dict) -> List[Dict]:
+        if noteable.get("user_notes_count") == 0:
+            return []
+
+        return await self._get_all_paginated(
+            f"/projects/{noteable['project_id']}/{noteable_type}/{noteable['iid']}/notes", {"sort": "asc"})
+
+    def _notes_to_comments(self, raw_notes: List[Dict], noteable: Dict) -> List[BasicDocument]:
         comments = []
-        issue_url = issue['web_url']
-
-        for raw_comment in raw_comments:
-            if raw_comment["system"]:
+        for raw_note in raw_notes:
+            if raw_note["system"]:
                 continue
 
             comments.append(BasicDocument(
-                id=raw_comment["id"],
+                id=raw_note["id"],
                 data_source_id=self._data_source_id,
                 type=DocumentType.COMMENT,
-                title=raw_comment["author"]["name"],
-                content=raw_comment["body"],
-                author=raw_comment["author"]["name"],
-                author_image_url=raw_comment["author"]["avatar_url"],
-                location=issue['references']['full'].replace("/", " / "),
-                url=issue_url,
-                timestamp=dateutil.parser.parse(raw_comment["updated_at"])
+                title=raw_note["author"]["name"],
+                content=raw_note["body"],
+                author=raw_note["author"]["name"],
+                author_image_url=raw_note["author"]["avatar_url"],
+                location=noteable['references']['full'].replace("/", " / "),
+                url=noteable['web_url'],
+                timestamp=dateutil.parser.parse(raw_note["updated_at"])
             ))
+        return comments
 
-        status = gitlab_status_to_doc_status(issue["state"])
+    def _noteable_to_document(self, noteable: Dict, raw_notes: List[Dict], doc_type: DocumentType,
+                              doc_id: Union[int, str]) -> BasicDocument:
+        status = gitlab_status_to_doc_status(noteable["state"])
         is_active = status == DocumentStatus.OPEN
-        doc = BasicDocument(
-            id=issue["id"],
+        return BasicDocument(
+            id=doc_id,
             data_source_id=self._data_source_id,
-            type=DocumentType.ISSUE,
-            title=issue['title'],
-            content=issue.get("description") or "",
-            author=issue['author']['name'],
-            author_image_url=issue['author']['avatar_url'],
-            location=issue['references']['full'].replace("/", " / "),
-            url=issue['web_url'],
-            timestamp=updated_at,
-            status=issue["state"],
+            type=doc_type,
+            title=noteable['title'],
+            content=noteable.get("description") or "",
+            author=noteable['author']['name'],
+            author_image_url=noteable['author']['avatar_url'],
+            location=noteable['references']['full'].replace("/", " / "),
+            url=noteable['web_url'],
+            timestamp=dateutil.parser.parse(noteable["updated_at"]),
+            status=noteable["state"],
             is_active=is_active,
-            children=comments
+            children=self._notes_to_comments(raw_notes, noteable)
         )
-        IndexQueue.get_instance().put_single(doc=doc)
+
+    def _issue_to_document(self, issue: Dict, raw_notes: List[Dict]) -> BasicDocument:
+        return self._noteable_to_document(issue, raw_notes, DocumentType.ISSUE, doc_id=issue["id"])
+
+    def _merge_request_to_document(self, merge_request: Dict, raw_notes: List[Dict]) -> BasicDocument:
+        # issues and merge requests are numbered separately, so their ids collide
+        return self._noteable_to_document(merge_request, raw_notes, DocumentType.GIT_PR,
+                                          doc_id=f"mr-{merge_request['id']}")
+
+    async def feed_issue(self, issue: Dict):
+        # tasks queued by older versions, which fed every issue in its own task
+        updated_at = dateutil.parser.parse(issue["updated_at"])
+        if self._is_prior_to_last_index_time(doc_time=updated_at):
+            logger.info(f"Issue {issue['id']} is too old, skipping")
+            return
+
+        raw_notes = await self._get_notes("issues", issue)
+        IndexQueue.get_instance().put_single(doc=self._issue_to_document(issue, raw_notes))
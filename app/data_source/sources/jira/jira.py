@@ -11,6 +11,7 @@ from atlassian.errors import ApiError
 from data_source.api.base_data_source import BaseDataSource, ConfigField, HTMLInputType, Location, BaseDataSourceConfig
 from data_source.api.basic_document import BasicDocument, DocumentType, DocumentStatus
 from data_source.api.exception import InvalidDataSourceConfig
+from data_source.api.rate_limiter import RateLimit
 from queues.index_queue import IndexQueue
 
 
@@ -23,6 +24,9 @@ logger = logging.getLogger(__name__)
 
 
 class JiraDataSource(BaseDataSource):
+    RATE_LIMIT = RateLimit(per_request=True)
+    # the fields read by _issue_to_document, comments are embedded in the search results
+    ISSUE_FIELDS = 'summary,description,status,updated,assignee,reporter,creator,comment'
 
     @classmethod
     def get_display_name(cls) -> str:
@@ -66,7 +70,8 @@ class JiraDataSource(BaseDataSource):
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self._jira = JiraDataSource.client_from_config(self._raw_config)
+        self._jira = self.client_from_config(self._raw_config)
+        self._meter_requests(self._jira.session)
 
     def _feed_new_documents(self) -> None:
         logger.info('Feeding new documents with Jira')
@@ -79,30 +84,68 @@ class JiraDataSource(BaseDataSource):
 
         start = 0
         limit = 100
-        last_index_time = self._last_index_time.strftime("%Y-%m-%d %H:%M")
+        last_index_time = self._get_location_index_time(project.value).strftime("%Y-%m-%d %H:%M")
         jql_query = f'project = "{project.value}" AND updated >= "{last_index_time}" ORDER BY updated DESC'
         logger.info(f'Querying jira with JQL: {jql_query}')
+        high_water_mark = None
+        # the oldest issue fed by its own task, the cursor stays before it in case that task fails
+        oldest_fallback = None
         while True:
-            new_batch = self._jira.jql_get_list_of_tickets(jql_query, start=start, limit=limit, validate_query=True)
+            response = self._jira.jql(jql_query, fields=self.ISSUE_FIELDS, start=start, limit=limit,
+                                      validate_query=True)
+            new_batch = response['issues']
             len_new_batch = len(new_batch)
             logger.info(f'Got {len_new_batch} issues from project {project.label} (total {start + len_new_batch})')
-            for raw_issue in new_batch:
-                self.add_task_to_queue(self._feed_issue, raw_issue=raw_issue, project_name=project.label)
 
-            if len(new_batch) < limit:
+            docs = []
+            for raw_issue in new_batch:
+                updated = raw_issue.get('fields', {}).get('updated')
+                if updated is not None:
+                    updated = dateutil.parser.parse(updated)
+                    if high_water_mark is None or updated > high_water_mark:
+                        high_water_mark = updated
+
+                try:
+                    docs.append(self._issue_to_document(raw_issue, project_name=project.label))
+                except Exception as e:
+                    # a malformed issue or a failed comments fetch only fails that issue's own task
+                    logger.warning(f'Could not feed issue {raw_issue.get("key")} with its page, '
+                                   f'feeding it on its own: {e}')
+                    self.add_task_to_queue(self._feed_issue, raw_issue=raw_issue, project_name=project.label)
+                    if updated is not None and (oldest_fallback is None or updated < oldest_fallback):
+                        oldest_fallback = updated
+            if docs:
+                IndexQueue.get_instance().put(docs=docs)
+
+            start += len_new_batch
+            if len_new_batch == 0 or start >= response['total']:
                 break
 
-            start += limit
+        if oldest_fallback is not None:
+            # the next sync lists the issue again (updated >= cursor), the issues after it are skipped as unchanged
+            high_water_mark = min(high_water_mark, oldest_fallback)
+        if high_water_mark is not None:
+            self._save_location_cursor(project.value, high_water_mark.isoformat())
+
+    def _get_comments(self, raw_issue: Dict) -> List[Dict]:
+        embedded = raw_issue['fields'].get('comment')
+        if embedded is not None and len(embedded['comments']) >= embedded['total']:
+            return embedded['comments']
+
+        # the search embeds a limited number of comments, only issues with more are fetched on their own
+        return self._jira.issue_get_comments(raw_issue['id'])['comments']
 
     def _feed_issue(self, raw_issue: Dict, project_name: str):
+        IndexQueue.get_instance().put_single(doc=self._issue_to_document(raw_issue, project_name))
+
+    def _issue_to_document(self, raw_issue: Dict, project_name: str) -> BasicDocument:
         issue_id = raw_issue['id']
         last_modified = dateutil.parser.parse(raw_issue['fields']['updated'])
 
         base_url = self._raw_config['url']
         issue_url = urllib.parse.urljoin(base_url, f"/browse/{raw_issue['key']}")
         comments = []
-        raw_comments = self._jira.issue_get_comments(issue_id)
-        for raw_comment in raw_comments['comments']:
+        for raw_comment in self._get_comments(raw_issue):
             comments.append(BasicDocument(
                 id=raw_comment["id"],
                 data_source_id=self._data_source_id,
@@ -133,19 +176,18 @@ class JiraDataSource(BaseDataSource):
 
         content = raw_issue['fields']['description']
         title = raw_issue['fields']['summary']
-        doc = BasicDocument(title=title,
-                            content=content,
-                            author=author_name,
-                            author_image_url=author_image_url,
-                            timestamp=last_modified,
-                            id=issue_id,
-                            data_source_id=self._data_source_id,
-                            location=project_name,
-                            url=issue_url,
-                            status=raw_issue['fields']['status']['name'],
-                            type=DocumentType.ISSUE,
-                            children=comments)
-        IndexQueue.get_instance().put_single(doc=doc)
+        return BasicDocument(title=title,
+                             content=content,
+                             author=author_name,
+                             author_image_url=author_image_url,
+                             timestamp=last_modified,
+                             id=issue_id,
+                             data_source_id=self._data_source_id,
+                             location=project_name,
+                             url=issue_url,
+                             status=raw_issue['fields']['status']['name'],
+                             type=DocumentType.ISSUE,
+                             children=comments)
 
 
 # if __name__ == '__main__':
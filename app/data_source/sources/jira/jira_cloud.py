@@ -45,7 +45,3 @@ class JiraCloudDataSource(JiraDataSource):
     def list_locations(config: Dict) -> List[Location]:
         jira = JiraCloudDataSource.client_from_config(config)
         return JiraDataSource.list_projects(jira=jira)
-
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        self._jira = JiraCloudDataSource.client_from_config(self._raw_config)
@@ -1,17 +1,24 @@
 import datetime
+import json
 import logging
-import time
 from dataclasses import dataclass
 from http.client import IncompleteRead
-from typing import Optional, Dict, List
+from typing import Optional, Dict, List, Iterator, Tuple
 
 from retry import retry
 from slack_sdk import WebClient
 from slack_sdk.errors import SlackApiError
+from sqlalchemy import func
+from sqlalchemy.dialects.sqlite import insert
 
 from data_source.api.base_data_source import BaseDataSource, ConfigField, HTMLInputType, BaseDataSourceConfig
 from data_source.api.basic_document import DocumentType, BasicDocument
+from data_source.api.exception import RateLimitedException
+from data_source.api.rate_limiter import RateLimit, RateLimiter
+from data_source.api.utils import get_utc_time_now
+from db_engine import Session
 from queues.index_queue import IndexQueue
+from schemas import SlackUser
 
 logger = logging.getLogger(__name__)
 
@@ -34,6 +41,10 @@ class SlackConfig(BaseDataSourceConfig):
 
 class SlackDataSource(BaseDataSource):
     FEED_BATCH_SIZE = 500
+    # conversations.history and conversations.replies are tier 3 methods, about 50 requests a minute
+    RATE_LIMIT = RateLimit(max_concurrency=4, tokens_per_second=0.8, burst=5, per_request=True)
+    # the user directory of a workspace is fetched again with users.list once it is this old
+    USER_DIRECTORY_MAX_AGE = datetime.timedelta(days=1)
 
     @staticmethod
     def get_config_fields() -> List[ConfigField]:
@@ -55,7 +66,9 @@ class SlackDataSource(BaseDataSource):
         super().__init__(*args, **kwargs)
         slack_config = SlackConfig(**self._raw_config)
         self._slack = WebClient(token=slack_config.token)
+        self._meter_requests(self._slack, 'api_call')
         self._authors_cache: Dict[str, SlackAuthor] = {}
+        self._team_id: Optional[str] = None
 
     def _list_conversations(self) -> List[SlackConversation]:
         conversations = self._slack.conversations_list(exclude_archived=True, limit=1000)
@@ -76,68 +89,236 @@ class SlackDataSource(BaseDataSource):
 
         return joined_conversations
 
+    @staticmethod
+    def _to_author(user: Dict) -> SlackAuthor:
+        name = user.get('real_name') or user.get('name') or user.get('profile', {}).get('display_name') or 'Unknown'
+        return SlackAuthor(name=name, image_url=user.get('profile', {}).get('image_72', ''))
+
+    def _get_team_id(self) -> str:
+        if self._team_id is None:
+            self._team_id = self._slack.auth_test()['team_id']
+        return self._team_id
+
+    @retry(exceptions=(SlackApiError, IncompleteRead), tries=5, delay=1, backoff=2, logger=logger)
+    def _list_users(self, cursor: Optional[str]):
+        try:
+            return self._slack.users_list(limit=1000, cursor=cursor)
+        except SlackApiError as e:
+            if e.response['error'] == 'ratelimited':
+                raise RateLimitedException(retry_after=int(e.response['headers']['Retry-After'])) from e
+            raise e
+
+    def _prefetch_user_directory(self):
+        """
+        Saves all the users of the workspace, a users.list request per 1000 users instead of a users.info per author.
+        The directory is shared by the data sources of the workspace, and kept until USER_DIRECTORY_MAX_AGE passed.
+        """
+        team_id = self._get_team_id()
+        with Session() as session:
+            last_update = session.query(func.max(SlackUser.updated_at)).filter_by(team_id=team_id).scalar()
+        if last_update is not None and \
+                get_utc_time_now().replace(tzinfo=None) - last_update < self.USER_DIRECTORY_MAX_AGE:
+            return
+
+        users = []
+        cursor = None
+        while True:
+            response = self._list_users(cursor=cursor)
+            users.extend(response['members'])
+            cursor = response.get('response_metadata', {}).get('next_cursor')
+            if not cursor:
+                break
+
+        updated_at = get_utc_time_now()
+        with Session() as session:
+            for user in users:
+                author = self._to_author(user)
+                statement = insert(SlackUser).values(team_id=team_id, user_id=user['id'], name=author.name,
+                                                     image_url=author.image_url, updated_at=updated_at)
+                statement = statement.on_conflict_do_update(
+                    index_elements=[SlackUser.team_id, SlackUser.user_id],
+                    set_={'name': statement.excluded.name, 'image_url': statement.excluded.image_url,
+                          'updated_at': statement.excluded.updated_at})
+                session.execute(statement)
+            session.commit()
+        logger.info(f'Saved {len(users)} users of workspace {team_id}')
+
     def _get_author_details(self, author_id: str) -> SlackAuthor:
         author = self._authors_cache.get(author_id, None)
         if author is None:
-            author_info = self._slack.users_info(user=author_id)
-            user = author_info['user']
-            name = user.get('real_name') or user.get('name') or user.get('profile', {}).get('display_name') or 'Unknown'
-            author = SlackAuthor(name=name,
-                                 image_url=author_info['user']['profile']['image_72'])
-            self._authors_cache[author_id] = author
+            with Session() as session:
+                user = session.query(SlackUser).filter_by(team_id=self._get_team_id(), user_id=author_id).first()
+                if user is not None:
+                    author = SlackAuthor(name=user.name, image_url=user.image_url)
+
+        if author is None:
+            # joined the workspace after the directory was fetched
+            author = self._to_author(self._slack.users_info(user=author_id)['user'])
 
+        self._authors_cache[author_id] = author
         return author
 
     def _feed_new_documents(self) -> None:
         conversations = self._list_conversations()
         logger.info(f'Found {len(conversations)} conversations')
 
+        try:
+            self._prefetch_user_directory()
+        except Exception as e:
+            logger.warning(f'Could not fetch the user directory, authors will be fetched one by one: {e}')
+
         self._feed_conversations(conversations)
 
+    @staticmethod
+    def _position_key(conv: SlackConversation) -> str:
+        return f'{conv.id}#position'
+
+    def _get_message_author(self, message: Dict) -> Optional[SlackAuthor]:
+        if author_id := message.get('user'):
+            return self._get_author_details(author_id)
+        if message.get('bot_id'):
+            return SlackAuthor(name=message.get('username'), image_url=message.get('icons', {}).get('image_48'))
+
+        logger.warning(f'Unknown message author: {message}')
+        return None
+
+    def _message_to_document(self, conv: SlackConversation, message: Dict, author: SlackAuthor,
+                             doc_type: DocumentType) -> BasicDocument:
+        timestamp = message['ts']
+        message_id = message.get('client_msg_id') or timestamp
+        readable_timestamp = datetime.datetime.fromtimestamp(float(timestamp))
+        message_url = f"https://slack.com/app_redirect?channel={conv.id}&message_ts={timestamp}"
+        return BasicDocument(title=author.name, content=message['text'], author=author.name,
+                             timestamp=readable_timestamp, id=message_id,
+                             data_source_id=self._data_source_id, location=conv.name,
+                             url=message_url, author_image_url=author.image_url,
+                             type=doc_type)
+
     def _feed_conversation(self, conv: SlackConversation):
         logger.info(f'Feeding conversation {conv.name}')
 
+        # the cursor is the ts of the newest message fed, oldest is exclusive so it isn't fetched again
+        oldest = self._get_location_cursor(conv.id) or str(self._last_index_time.timestamp())
+        page_cursor = None
+        newest_ts = None
+        fed_until = None
+        # a fetch that failed continues from the last message it fed
+        if position := self._get_location_cursor(self._position_key(conv)):
+            position = json.loads(position)
+            oldest, page_cursor, newest_ts = position['oldest'], position['cursor'], position['newest_ts']
+            fed_until = position.get('fed_until')
+            logger.info(f'Resuming conversation {conv.name}')
+
+        try:
+            self._feed_conversation_pages(conv, oldest=oldest, page_cursor=page_cursor, newest_ts=newest_ts,
+                                          fed_until=fed_until)
+        except SlackApiError as e:
+            if page_cursor is None or e.response['error'] != 'invalid_cursor':
+                raise e
+            logger.warning(f'Could not resume conversation {conv.name} ({e}), starting over')
+            self._delete_location_cursor(self._position_key(conv))
+            self._feed_conversation_pages(conv, oldest=oldest, page_cursor=None, newest_ts=None, fed_until=None)
+
+    def _save_position(self, conv: SlackConversation, oldest: str, page_cursor: Optional[str],
+                       newest_ts: Optional[str], fed_until: Optional[str]):
+        """
+        Everything newer than fed_until was fed, None if the whole page before page_cursor was
+        """
+        self._save_location_cursor(self._position_key(conv), json.dumps({
+            'oldest': oldest, 'cursor': page_cursor, 'newest_ts': newest_ts, 'fed_until': fed_until}))
+
+    def _feed_conversation_pages(self, conv: SlackConversation, oldest: str, page_cursor: Optional[str],
+                                 newest_ts: Optional[str], fed_until: Optional[str]):
+        docs: List[BasicDocument] = []
         last_msg: Optional[BasicDocument] = None
 
-        messages = self._fetch_conversation_messages(conv)
-        for message in messages:
-            if not self._is_valid_message(message):
-                if last_msg is not None:
-                    IndexQueue.get_instance().put_single(doc=last_msg)
-                    last_msg = None
-                continue
-
-            text = message['text']
-            if author_id := message.get('user'):
-                author = self._get_author_details(author_id)
-            elif message.get('bot_id'):
-                author = SlackAuthor(name=message.get('username'), image_url=message.get('icons', {}).get('image_48'))
-            else:
-                logger.warning(f'Unknown message author: {message}')
-                continue
-
-            if last_msg is not None:
-                if last_msg.author == author.name:
-                    last_msg.content += f"\n{text}"
+        for messages, next_cursor in self._iter_conversation_messages(conv, oldest=oldest, cursor=page_cursor):
+            # messages are returned newest first
+            if newest_ts is None and len(messages) > 0:
+                newest_ts = messages[0]['ts']
+
+            for message in messages:
+                if fed_until is not None and float(message['ts']) >= float(fed_until):
                     continue
-                else:
-                    IndexQueue.get_instance().put_single(doc=last_msg)
+
+                if not self._is_valid_message(message):
+                    if last_msg is not None:
+                        docs.append(last_msg)
+                        last_msg = None
+                    continue
+
+                author = self._get_message_author(message)
+                if author is None:
+                    continue
+
+                is_thread = message.get('reply_count', 0) > 0
+                if last_msg is not None:
+                    # a thread is its own document, so its replies stay attached to the message they answer
+                    if last_msg.author == author.name and not is_thread and not last_msg.children:
+                        last_msg.content += f"\n{message['text']}"
+                        continue
+                    else:
+                        docs.append(last_msg)
+                        last_msg = None
+
+                last_msg = self._message_to_document(conv, message, author, DocumentType.MESSAGE)
+                if is_thread:
+                    last_msg.children = self._fetch_thread_replies(conv, message)
+                    # every thread costs a request, so a retry continues after the last thread fetched
+                    docs.append(last_msg)
                     last_msg = None
+                    IndexQueue.get_instance().put(docs=docs)
+                    docs = []
+                    self._save_position(conv, oldest, page_cursor, newest_ts, fed_until=message['ts'])
+            fed_until = None
 
-            timestamp = message['ts']
-            message_id = message.get('client_msg_id') or timestamp
-            readable_timestamp = datetime.datetime.fromtimestamp(float(timestamp))
-            message_url = f"https://slack.com/app_redirect?channel={conv.id}&message_ts={timestamp}"
-            last_msg = BasicDocument(title=author.name, content=text, author=author.name,
-                                     timestamp=readable_timestamp, id=message_id,
-                                     data_source_id=self._data_source_id, location=conv.name,
-                                     url=message_url, author_image_url=author.image_url,
-                                     type=DocumentType.MESSAGE)
+            # fed while the next pages are fetched, instead of holding the whole history in memory
+            if len(docs) >= self.FEED_BATCH_SIZE and next_cursor is not None:
+                if last_msg is not None:
+                    docs.append(last_msg)
+                    last_msg = None
+                IndexQueue.get_instance().put(docs=docs)
+                docs = []
+                self._save_position(conv, oldest, next_cursor, newest_ts, fed_until=None)
+            page_cursor = next_cursor
 
         if last_msg is not None:
-            IndexQueue.get_instance().put_single(doc=last_msg)
+            docs.append(last_msg)
+        if len(docs) > 0:
+            IndexQueue.get_instance().put(docs=docs)
+
+        if newest_ts is not None:
+            self._save_location_cursor(conv.id, newest_ts)
+        self._delete_location_cursor(self._position_key(conv))
 
-    @retry(tries=5, delay=1, backoff=2, logger=logger)
+    def _fetch_thread_replies(self, conv: SlackConversation, parent: Dict) -> List[BasicDocument]:
+        replies = []
+        cursor = None
+        while True:
+            response = self._get_thread_replies(conv=conv, thread_ts=parent['ts'], cursor=cursor)
+            for message in response['messages']:
+                # the parent message is returned first
+                if message['ts'] == parent['ts'] or not self._is_valid_message(message):
+                    continue
+                if author := self._get_message_author(message):
+                    replies.append(self._message_to_document(conv, message, author, DocumentType.COMMENT))
+
+            if not response.get('has_more'):
+                return replies
+            cursor = response['response_metadata']['next_cursor']
+
+    @retry(exceptions=(SlackApiError, IncompleteRead), tries=5, delay=1, backoff=2, logger=logger)
+    def _get_thread_replies(self, conv: SlackConversation, thread_ts: str, cursor: Optional[str]):
+        try:
+            return self._slack.conversations_replies(channel=conv.id, ts=thread_ts, limit=1000, cursor=cursor)
+        except SlackApiError as e:
+            logger.warning(f'SlackApi error while fetching replies of {thread_ts} in conversation {conv.name}: {e}')
+            if e.response['error'] == 'ratelimited':
+                # retried here once the pause ends, retrying the task would fetch the replies of its page again
+                RateLimiter.throttle(self._data_source_id, int(e.response['headers']['Retry-After']), self.RATE_LIMIT)
+            raise e
+
+    @retry(exceptions=(SlackApiError, IncompleteRead), tries=5, delay=1, backoff=2, logger=logger)
     def _get_conversation_history(self, conv: SlackConversation, cursor: str, last_index_unix: str):
         try:
             return self._slack.conversations_history(channel=conv.id, oldest=last_index_unix,
@@ -146,34 +327,26 @@ class SlackDataSource(BaseDataSource):
             logger.warning(f'SlackApi error while fetching messages for conversation {conv.name}: {e}')
             response = e.response
             if response['error'] == 'ratelimited':
-                retry_after_seconds = int(response['headers']['Retry-After'])
-                logger.warning(f'Rate-limited: Slack API rate limit exceeded,'
-                               f' retrying after {retry_after_seconds} seconds')
-                time.sleep(retry_after_seconds)
+                # the workers pause this data source and retry the task, instead of sleeping here
+                raise RateLimitedException(retry_after=int(response['headers']['Retry-After'])) from e
             raise e
         except IncompleteRead as e:
             logger.warning(f'IncompleteRead error while fetching messages for conversation {conv.name}')
             raise e
 
-    def _fetch_conversation_messages(self, conv: SlackConversation):
-        messages = []
-        cursor = None
-        has_more = True
-        last_index_unix = self._last_index_time.timestamp()
+    def _iter_conversation_messages(self, conv: SlackConversation, oldest: str,
+                                    cursor: Optional[str] = None) -> Iterator[Tuple[List[Dict], Optional[str]]]:
+        """
+        Yields the pages of messages newer than oldest as they are fetched, newest first,
+        with the cursor of the page after them (None for the last page)
+        """
         logger.info(f'Fetching messages for conversation {conv.name}')
 
-        while has_more:
-            try:
-                response = self._get_conversation_history(conv=conv, cursor=cursor,
-                                                          last_index_unix=str(last_index_unix))
-            except Exception as e:
-                logger.warning(f'Error fetching all messages for conversation {conv.name},'
-                               f' returning {len(messages)} messages. Error: {e}')
-                return messages
-
+        while True:
+            response = self._get_conversation_history(conv=conv, cursor=cursor, last_index_unix=oldest)
             logger.info(f'Fetched {len(response["messages"])} messages for conversation {conv.name}')
-            messages.extend(response['messages'])
-            if has_more := response["has_more"]:
-                cursor = response["response_metadata"]["next_cursor"]
+            cursor = response["response_metadata"]["next_cursor"] if response["has_more"] else None
+            yield response['messages'], cursor
 
-        return messages
+            if cursor is None:
+                return
@@ -1,19 +1,35 @@
 import logging
+import os
 import threading
-from typing import List
+import time
+from typing import List, Optional
 
+from data_source.api.basic_document import BasicDocument
+from models import bi_encoder
 from queues.index_queue import IndexQueue
-from indexing.index_documents import Indexer
+from indexing.embedding_pool import EmbeddingPool
+from indexing.index_documents import Indexer, PARAGRAPH_MIN_LENGTH
 
 
 logger = logging.getLogger()
 
 
 class BackgroundIndexer:
+    # chunk size adapts to the observed throughput, so a chunk takes about TARGET_CHUNK_SECONDS to index
+    MIN_CHUNK_DOCS = 50
+    MAX_CHUNK_DOCS = 5000
+    TARGET_CHUNK_SECONDS = 60
+    # upper bound on the memory held by a single chunk, for its content and the embeddings of its paragraphs
+    MEMORY_BUDGET_BYTES = int(os.environ.get('INDEXING_MEMORY_BUDGET_MB', 256)) * 1024 * 1024
+
     _thread = None
     _stop_event = threading.Event()
     _currently_indexing_count = 0
     _total_indexed_count = 0
+    _total_skipped_count = 0
+    _chunk_size = 500
+    _docs_per_second = 0.0
+    _embedding_bytes: Optional[int] = None
 
     @classmethod
     def get_currently_indexing(cls) -> int:
@@ -23,9 +39,50 @@ class BackgroundIndexer:
     def get_indexed_count(cls) -> int:
         return cls._total_indexed_count
 
+    @classmethod
+    def get_skipped_count(cls) -> int:
+        return cls._total_skipped_count
+
+    @classmethod
+    def get_docs_per_second(cls) -> float:
+        return cls._docs_per_second
+
+    @classmethod
+    def _adapt_chunk_size(cls, docs_count: int, elapsed: float):
+        cls._docs_per_second = docs_count / max(elapsed, 1e-3)
+        # only grow when the chunk was full, a small chunk says nothing about the capacity
+        if docs_count < cls._chunk_size and cls._docs_per_second * cls.TARGET_CHUNK_SECONDS > cls._chunk_size:
+            return
+
+        target = int(cls._docs_per_second * cls.TARGET_CHUNK_SECONDS)
+        cls._chunk_size = max(cls.MIN_CHUNK_DOCS, min(cls.MAX_CHUNK_DOCS, target))
+        logger.info(f'Indexed {docs_count} documents in {elapsed:.1f}s ({cls._docs_per_second:.1f} docs/s), '
+                    f'next chunk size is {cls._chunk_size}')
+
+    @classmethod
+    def _get_embedding_bytes(cls) -> int:
+        """
+        Memory of the embedding of a paragraph, float32 values kept in a tensor,
+        and in the shared memory buffer the embedding pool writes them to
+        """
+        if cls._embedding_bytes is None:
+            copies = 2 if EmbeddingPool.is_enabled() else 1
+            cls._embedding_bytes = bi_encoder.get_sentence_embedding_dimension() * 4 * copies
+        return cls._embedding_bytes
+
+    @classmethod
+    def _estimate_memory(cls, doc: BasicDocument) -> int:
+        # a paragraph is at least PARAGRAPH_MIN_LENGTH characters, except for the last one of a document
+        content_length = len(doc.content or '')
+        size = content_length + (content_length // PARAGRAPH_MIN_LENGTH + 1) * cls._get_embedding_bytes()
+        for child in doc.children or []:
+            size += cls._estimate_memory(child)
+        return size
+
     @classmethod
     def reset_indexed_count(cls):
         cls._total_indexed_count = 0
+        cls._total_skipped_count = 0
 
     @classmethod
     def start(cls):
@@ -37,7 +94,10 @@ class BackgroundIndexer:
         cls._stop_event.set()
         logging.info('Stop event set, waiting for background indexer to stop...')
 
-        cls._thread.join()
+        # the indexer blocks until documents arrive, wake it up until it sees the stop event
+        while cls._thread.is_alive():
+            IndexQueue.get_instance().wake_up()
+            cls._thread.join(timeout=0.1)
         logging.info('Background indexer stopped')
 
         cls._thread = None
@@ -49,7 +109,9 @@ class BackgroundIndexer:
 
         while not BackgroundIndexer._stop_event.is_set():
             try:
-                queue_items = docs_queue_instance.consume_all()
+                queue_items = docs_queue_instance.consume_all(max_docs=BackgroundIndexer._chunk_size,
+                                                              max_size=BackgroundIndexer.MEMORY_BUDGET_BYTES,
+                                                              size_of=BackgroundIndexer._estimate_memory)
                 if not queue_items:
                     continue
 
@@ -57,7 +119,9 @@ class BackgroundIndexer:
                 logger.info(f'Got chunk of {len(queue_items)} documents')
 
                 docs = [doc.doc for doc in queue_items]
-                Indexer.index_documents(docs)
+                start_time = time.perf_counter()
+                BackgroundIndexer._total_skipped_count += Indexer.index_documents(docs)
+                BackgroundIndexer._adapt_chunk_size(len(docs), time.perf_counter() - start_time)
                 BackgroundIndexer._ack_chunk(docs_queue_instance, [doc.queue_item_id for doc in queue_items])
             except Exception as e:
                 logger.exception(e)
@@ -1,14 +1,18 @@
 import os
 import pickle
-from typing import List
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import List, Optional, Dict, Iterable
 
 import nltk
 import numpy as np
 from rank_bm25 import BM25Okapi
 
 from db_engine import Session
-from paths import BM25_INDEX_PATH
-from schemas import Paragraph
+from paths import BM25_INDEX_PATH, BM25_SHARDS_PATH
+from schemas import Paragraph, Document
+
+SEARCH_WORKERS = 8
 
 
 def _add_metadata_for_indexing(paragraph: Paragraph) -> str:
@@ -22,7 +26,30 @@ def _add_metadata_for_indexing(paragraph: Paragraph) -> str:
     return result
 
 
+@dataclass
+class Bm25Shard:
+    index: BM25Okapi
+    id_map: List[int]
+
+    def search(self, tokenized_query: List[str], top_k: int, allowed_ids: Optional[np.ndarray] = None) -> List[Dict]:
+        if allowed_ids is None:
+            corpus_indices = np.arange(len(self.id_map))
+            bm25_scores = self.index.get_scores(tokenized_query)
+        else:
+            # only score the documents that passed the filters
+            corpus_indices = np.flatnonzero(np.isin(np.asarray(self.id_map), allowed_ids))
+            if len(corpus_indices) == 0:
+                return []
+            bm25_scores = self.index.get_batch_scores(tokenized_query, corpus_indices.tolist())
+        top_k = min(top_k, len(bm25_scores))
+        top_n = np.argpartition(bm25_scores, -top_k)[-top_k:]
+        return [{'id': self.id_map[corpus_indices[idx]], 'score': bm25_scores[idx]} for idx in top_n]
+
+
 class Bm25Index:
+    """
+    Keeps one BM25 index (shard) per data source, indexing a data source only rebuilds its own shard.
+    """
     instance = None
 
     @staticmethod
@@ -30,11 +57,7 @@ class Bm25Index:
         if Bm25Index.instance is not None:
             raise RuntimeError("Index is already initialized")
 
-        if os.path.exists(BM25_INDEX_PATH):
-            with open(BM25_INDEX_PATH, 'rb') as f:
-                Bm25Index.instance = pickle.load(f)
-        else:
-            Bm25Index.instance = Bm25Index()
+        Bm25Index.instance = Bm25Index()
 
     @staticmethod
     def get() -> 'Bm25Index':
@@ -43,46 +66,89 @@ class Bm25Index:
         return Bm25Index.instance
 
     def __init__(self) -> None:
-        self.index = None
-        self.id_map = []
-
-    def _update(self, session):
-        all_paragraphs = session.query(Paragraph).all()
-        if len(all_paragraphs) == 0:
-            self.index = None
-            self.id_map = []
-            return
+        self.shards: Dict[int, Bm25Shard] = {}
+        self._executor = ThreadPoolExecutor(max_workers=SEARCH_WORKERS)
+        for file_name in os.listdir(BM25_SHARDS_PATH):
+            if file_name.endswith('.bin'):
+                with open(BM25_SHARDS_PATH / file_name, 'rb') as f:
+                    self.shards[int(file_name[:-len('.bin')])] = pickle.load(f)
+
+        if os.path.exists(BM25_INDEX_PATH):
+            # older versions kept a single index for all data sources
+            self.update()
+            os.remove(BM25_INDEX_PATH)
 
-        corpus = [nltk.word_tokenize(_add_metadata_for_indexing(paragraph)) for paragraph in all_paragraphs]
-        id_map = [paragraph.id for paragraph in all_paragraphs]
-        self.index = BM25Okapi(corpus)
-        self.id_map = id_map
+    @staticmethod
+    def _shard_path(data_source_id: int) -> str:
+        return str(BM25_SHARDS_PATH / f'{data_source_id}.bin')
+
+    def _update_shard(self, session, data_source_id: int):
+        paragraphs = session.query(Paragraph).join(Document, Paragraph.document_id == Document.id) \
+            .filter(Document.data_source_id == data_source_id).all()
+        if len(paragraphs) == 0:
+            self.drop_shard(data_source_id)
+            return
 
-    def update(self, session=None):
+        corpus = [nltk.word_tokenize(_add_metadata_for_indexing(paragraph)) for paragraph in paragraphs]
+        id_map = [paragraph.id for paragraph in paragraphs]
+        self.shards[data_source_id] = Bm25Shard(index=BM25Okapi(corpus), id_map=id_map)
+        with open(self._shard_path(data_source_id), 'wb') as f:
+            pickle.dump(self.shards[data_source_id], f)
+
+    def _update(self, session, data_source_ids: Optional[Iterable[int]] = None):
+        if data_source_ids is None:
+            data_source_ids = {row[0] for row in session.query(Document.data_source_id).distinct().all()}
+            for stale_id in set(self.shards.keys()) - data_source_ids:
+                self.drop_shard(stale_id)
+
+        for data_source_id in data_source_ids:
+            self._update_shard(session, data_source_id)
+
+    def update(self, session=None, data_source_ids: Optional[Iterable[int]] = None):
+        """
+        Rebuilds the shards of the given data sources, or all of them if data_source_ids is None
+        """
         if session is None:
             with Session() as session:
-                self._update(session)
+                self._update(session, data_source_ids)
         else:
-            self._update(session)
+            self._update(session, data_source_ids)
+
+    def rebuild(self):
+        self.update()
+
+    def add(self, paragraphs: List[Paragraph], session=None):
+        # BM25Okapi can't be updated incrementally, so the affected shards are rebuilt
+        self.update(session=session,
+                    data_source_ids={paragraph.document.data_source_id for paragraph in paragraphs})
+
+    def remove(self, paragraphs: List[Paragraph], session=None):
+        self.update(session=session,
+                    data_source_ids={paragraph.document.data_source_id for paragraph in paragraphs})
 
-        self._save()
+    def drop_shard(self, data_source_id: int, session=None):
+        self.shards.pop(data_source_id, None)
+        if os.path.exists(self._shard_path(data_source_id)):
+            os.remove(self._shard_path(data_source_id))
 
-    def search(self, query: str, top_k: int) -> List[int]:
-        if self.index is None:
+    def search(self, query: str, top_k: int, allowed_ids: Optional[List[int]] = None,
+               data_source_ids: Optional[List[int]] = None) -> List[int]:
+        if data_source_ids is None:
+            shards = list(self.shards.values())
+        else:
+            shards = [self.shards[data_source_id] for data_source_id in data_source_ids
+                      if data_source_id in self.shards]
+        if len(shards) == 0:
             return []
         tokenized_query = nltk.word_tokenize(query)
-        bm25_scores = self.index.get_scores(tokenized_query)
-        top_k = min(top_k, len(bm25_scores))
-        top_n = np.argpartition(bm25_scores, -top_k)[-top_k:]
-        bm25_hits = [{'id': self.id_map[idx], 'score': bm25_scores[idx]} for idx in top_n]
-        bm25_hits = sorted(bm25_hits, key=lambda x: x['score'], reverse=True)
+        if allowed_ids is not None:
+            allowed_ids = np.array(allowed_ids, dtype=np.int64)
+
+        results = self._executor.map(lambda shard: shard.search(tokenized_query, top_k, allowed_ids), shards)
+        bm25_hits = [hit for shard_hits in results for hit in shard_hits]
+        bm25_hits = sorted(bm25_hits, key=lambda x: x['score'], reverse=True)[:top_k]
         return [hit['id'] for hit in bm25_hits]
 
     def clear(self):
-        self.index = None
-        self.id_map = []
-        self._save()
-
-    def _save(self):
-        with open(BM25_INDEX_PATH, 'wb') as f:
-            pickle.dump(self, f)
+        for data_source_id in list(self.shards.keys()):
+            self.drop_shard(data_source_id)
@@ -0,0 +1,109 @@
+import logging
+import multiprocessing
+import os
+import time
+from multiprocessing import shared_memory
+from typing import List, Optional, Tuple
+
+import numpy as np
+import torch
+
+# number of embedding processes used for indexing, 0 encodes in the indexing thread and 'auto' uses all cores
+EMBEDDING_WORKERS = os.environ.get('EMBEDDING_WORKERS', '0')
+EMBEDDING_THREADS_PER_WORKER = int(os.environ.get('EMBEDDING_THREADS_PER_WORKER', 2))
+
+logger = logging.getLogger(__name__)
+
+_worker_model = None
+
+
+def _init_worker(model_name: str, threads: int):
+    global _worker_model
+    # import here so the parent process doesn't pay for it when the pool is disabled
+    from sentence_transformers import SentenceTransformer
+
+    torch.set_num_threads(threads)
+    _worker_model = SentenceTransformer(model_name, device='cpu')
+
+
+def _encode_into(shm_name: str, shape: Tuple[int, int], positions: List[int], contents: List[str],
+                 batch_size: int) -> Tuple[int, int, float]:
+    start_time = time.perf_counter()
+    embeddings = _worker_model.encode(contents, batch_size=batch_size, convert_to_numpy=True,
+                                      show_progress_bar=False)
+
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        output = np.ndarray(shape, dtype=np.float32, buffer=shm.buf)
+        output[positions] = embeddings
+        del output
+    finally:
+        shm.close()
+
+    return len(positions), sum(len(content) for content in contents), time.perf_counter() - start_time
+
+
+class EmbeddingPool:
+    """
+    Pool of processes holding their own bi-encoder, used to spread indexing over all CPU cores.
+    Workers write the embeddings straight into a shared memory buffer owned by the caller.
+    """
+    instance = None
+    _disabled = False
+
+    @staticmethod
+    def _workers_count() -> int:
+        if EMBEDDING_WORKERS == 'auto':
+            return max(1, (os.cpu_count() or 1) // EMBEDDING_THREADS_PER_WORKER)
+        return int(EMBEDDING_WORKERS)
+
+    @staticmethod
+    def is_enabled() -> bool:
+        return EmbeddingPool._workers_count() > 0
+
+    @staticmethod
+    def get(model_name: str) -> Optional['EmbeddingPool']:
+        """
+        Returns the pool, starting it on first use, or None if it is disabled
+        """
+        if EmbeddingPool.instance is None and not EmbeddingPool._disabled:
+            workers = EmbeddingPool._workers_count()
+            if workers <= 0:
+                EmbeddingPool._disabled = True
+                return None
+            EmbeddingPool.instance = EmbeddingPool(model_name, workers)
+        return EmbeddingPool.instance
+
+    @staticmethod
+    def stop():
+        if EmbeddingPool.instance is not None:
+            EmbeddingPool.instance._pool.terminate()
+            EmbeddingPool.instance._pool.join()
+            EmbeddingPool.instance = None
+
+    def __init__(self, model_name: str, workers: int):
+        logger.info(f'Starting {workers} embedding workers with {EMBEDDING_THREADS_PER_WORKER} threads each')
+        context = multiprocessing.get_context('spawn')
+        self._pool = context.Pool(processes=workers, initializer=_init_worker,
+                                  initargs=(model_name, EMBEDDING_THREADS_PER_WORKER))
+
+    def encode(self, contents: List[str], slices: List[List[int]], dimension: int,
+               batch_size: int) -> Tuple[torch.FloatTensor, List[Tuple[int, int, float]]]:
+        """
+        Encodes every slice (list of positions in contents) in a worker.
+        Returns the embeddings and (paragraphs, chars, seconds) of every slice.
+        """
+        shape = (len(contents), dimension)
+        shm = shared_memory.SharedMemory(create=True, size=max(1, len(contents) * dimension * 4))
+        try:
+            stats = self._pool.starmap(_encode_into, [(shm.name, shape, slice_positions,
+                                                       [contents[i] for i in slice_positions], batch_size)
+                                                      for slice_positions in slices], chunksize=1)
+            output = np.ndarray(shape, dtype=np.float32, buffer=shm.buf)
+            embeddings = torch.from_numpy(output.copy())
+            del output
+        finally:
+            shm.close()
+            shm.unlink()
+
+        return embeddings, stats
@@ -1,13 +1,171 @@
+import logging
 import os
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
 import torch
 import faiss
 
-from paths import FAISS_INDEX_PATH
+from db_engine import Session
+from paths import FAISS_INDEX_PATH, FAISS_SHARDS_PATH
+from schemas import Document, Paragraph
 
 MODEL_DIM = 384
+SEARCH_WORKERS = 8
+# how new shards store vectors: 'flat' (float32), 'fp16' or 'int8' (scalar quantized)
+VECTOR_STORAGE = os.environ.get('FAISS_VECTOR_STORAGE', 'flat')
+# the int8 quantizer learns the value range of every dimension from the vectors it is trained on, so int8 shards
+# stay flat until they hold this many vectors, and are then trained on all of them and converted
+MIN_TRAINING_VECTORS = 10_000
+# quantized shards also keep the float32 vectors on disk and rescore RESCORE_FACTOR * top_k results exactly
+RESCORE = os.environ.get('FAISS_RESCORE') is not None
+RESCORE_FACTOR = 4
+
+logger = logging.getLogger(__name__)
+
+
+def _new_index(storage: str = VECTOR_STORAGE) -> faiss.IndexIDMap:
+    if storage == 'fp16':
+        index = faiss.IndexScalarQuantizer(MODEL_DIM, faiss.ScalarQuantizer.QT_fp16, faiss.METRIC_INNER_PRODUCT)
+    elif storage == 'int8':
+        index = faiss.IndexScalarQuantizer(MODEL_DIM, faiss.ScalarQuantizer.QT_8bit, faiss.METRIC_INNER_PRODUCT)
+    else:
+        index = faiss.IndexFlatIP(MODEL_DIM)
+    return faiss.IndexIDMap(index)
+
+
+def _group_positions(keys: List[int]) -> Dict[int, List[int]]:
+    positions = defaultdict(list)
+    for position, key in enumerate(keys):
+        positions[key].append(position)
+    return positions
+
+
+class FaissShard:
+    """
+    The faiss index of a single data source. Quantized shards may keep the original float32 vectors
+    in a memory mapped side file, used to rescore their top results exactly.
+    """
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        if path.exists():
+            self.index: faiss.IndexIDMap = faiss.read_index(str(path))
+        else:
+            self.index = _new_index('flat' if VECTOR_STORAGE == 'int8' else VECTOR_STORAGE)
+        self.is_quantized = not isinstance(faiss.downcast_index(self.index.index), faiss.IndexFlat)
+        self._load_vectors()
+
+    @property
+    def _vectors_path(self) -> Path:
+        return self.path.with_suffix('.vectors')
+
+    @property
+    def _ids_path(self) -> Path:
+        return self.path.with_suffix('.ids')
+
+    @property
+    def _rescores(self) -> bool:
+        return RESCORE and self.is_quantized
+
+    def _load_vectors(self):
+        self._vectors = None
+        if not self._rescores or not self._ids_path.exists():
+            return
+
+        ids = np.fromfile(self._ids_path, dtype=np.int64)
+        if len(ids) == 0:
+            return
+        self._vectors = np.memmap(self._vectors_path, dtype=np.float32, mode='r', shape=(len(ids), MODEL_DIM))
+        # stable sort, so the last copy of a re-added id wins in _rows_of
+        self._sorted_rows = np.argsort(ids, kind='stable')
+        self._sorted_ids = ids[self._sorted_rows]
+
+    def _rows_of(self, ids: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Returns the rows of the ids in the side file, and a mask of the ids that were found there
+        """
+        positions = np.searchsorted(self._sorted_ids, ids, side='right') - 1
+        positions = np.clip(positions, 0, len(self._sorted_ids) - 1)
+        found = self._sorted_ids[positions] == ids
+        return self._sorted_rows[positions], found
+
+    def _write_vectors(self, ids: np.ndarray, embeddings: np.ndarray, mode: str):
+        with open(self._vectors_path, mode) as f:
+            f.write(embeddings.astype(np.float32).tobytes())
+        with open(self._ids_path, mode) as f:
+            f.write(ids.astype(np.int64).tobytes())
+        self._load_vectors()
+
+    def _compact_vectors(self):
+        live_ids = faiss.vector_to_array(self.index.id_map)
+        rows, found = self._rows_of(live_ids)
+        vectors = np.array(self._vectors[rows[found]])
+        self._vectors = None
+        self._write_vectors(live_ids[found], vectors, 'wb')
+
+    def _quantize(self):
+        """
+        Trains an int8 index on all the vectors of the flat index and moves them to it
+        """
+        ids = faiss.vector_to_array(self.index.id_map)
+        embeddings = self.index.index.reconstruct_n(0, self.index.ntotal)
+        index = _new_index('int8')
+        index.train(embeddings)
+        index.add_with_ids(embeddings, ids)
+
+        self.index = index
+        self.is_quantized = True
+        if self._rescores:
+            self._write_vectors(ids, embeddings, 'wb')
+        logger.info(f'Converted faiss shard {self.path.name} to int8, trained on {len(ids)} vectors')
+
+    def add(self, ids: np.ndarray, embeddings: np.ndarray):
+        self.index.add_with_ids(embeddings, ids)
+        if self._rescores:
+            self._write_vectors(ids, embeddings, 'ab')
+        elif VECTOR_STORAGE == 'int8' and not self.is_quantized and self.index.ntotal >= MIN_TRAINING_VECTORS:
+            self._quantize()
+
+    def remove(self, ids: np.ndarray):
+        self.index.remove_ids(ids)
+        # removed vectors stay in the side file until it is mostly garbage
+        if self._vectors is not None and len(self._vectors) > 2 * self.index.ntotal + 1000:
+            self._compact_vectors()
+
+    def search(self, queries: np.ndarray, top_k: int, *args, **kwargs) -> Tuple[np.ndarray, np.ndarray]:
+        if self._vectors is None:
+            return self.index.search(queries, top_k, *args, **kwargs)
+
+        scores, ids = self.index.search(queries, top_k * RESCORE_FACTOR, *args, **kwargs)
+        for query_index, query in enumerate(queries):
+            valid = ids[query_index] != -1
+            rows, found = self._rows_of(ids[query_index][valid])
+            valid_scores = scores[query_index][valid]
+            valid_scores[found] = self._vectors[rows[found]] @ query
+            scores[query_index][valid] = valid_scores
+
+        best = np.argsort(-scores, axis=1)[:, :top_k]
+        return np.take_along_axis(scores, best, axis=1), np.take_along_axis(ids, best, axis=1)
+
+    def save(self):
+        faiss.write_index(self.index, str(self.path))
+
+    def delete_files(self):
+        self._vectors = None
+        for path in [self.path, self._vectors_path, self._ids_path]:
+            if path.exists():
+                os.remove(path)
 
 
 class FaissIndex:
+    """
+    Keeps one faiss index (shard) per data source, so dropping or re-indexing a data source
+    never touches the vectors of the other data sources. Searches run on all shards in parallel.
+    """
     instance = None
 
     @staticmethod
@@ -24,30 +182,151 @@ class FaissIndex:
         return FaissIndex.instance
 
     def __init__(self) -> None:
+        self.shards: Dict[int, FaissShard] = {}
+        for file_name in os.listdir(FAISS_SHARDS_PATH):
+            if file_name.endswith('.bin'):
+                data_source_id = int(file_name[:-len('.bin')])
+                self.shards[data_source_id] = FaissShard(self._shard_path(data_source_id))
+
         if os.path.exists(FAISS_INDEX_PATH):
-            index = faiss.read_index(FAISS_INDEX_PATH)
-        else:
-            index = faiss.IndexFlatIP(MODEL_DIM)
-            index = faiss.IndexIDMap(index)
+            self._split_unsharded_index()
+
+        self._executor = ThreadPoolExecutor(max_workers=SEARCH_WORKERS)
+
+    @staticmethod
+    def _shard_path(data_source_id: int) -> Path:
+        return FAISS_SHARDS_PATH / f'{data_source_id}.bin'
+
+    def _split_unsharded_index(self):
+        """
+        Older versions kept a single index for all data sources, split it into shards once.
+        """
+        logger.info('Splitting faiss index into per data source shards...')
+        index = faiss.read_index(FAISS_INDEX_PATH)
+        ids = faiss.vector_to_array(index.id_map)
+        embeddings = index.index.reconstruct_n(0, index.ntotal)
+
+        with Session() as session:
+            rows = session.query(Paragraph.id, Document.data_source_id) \
+                .join(Document, Paragraph.document_id == Document.id).all()
+        data_source_by_paragraph = dict(rows)
 
-        self.index: faiss.IndexIDMap = index
+        known = [position for position, id in enumerate(ids) if int(id) in data_source_by_paragraph]
+        self.update(ids=[int(ids[position]) for position in known],
+                    embeddings=torch.from_numpy(embeddings[known]),
+                    data_source_ids=[data_source_by_paragraph[int(ids[position])] for position in known])
 
-    def update(self, ids: torch.LongTensor, embeddings: torch.FloatTensor):
-        self.index.add_with_ids(embeddings.cpu(), ids)
+        os.remove(FAISS_INDEX_PATH)
+        logger.info(f'Split {len(known)} vectors into {len(self.shards)} shards')
 
-        faiss.write_index(self.index, FAISS_INDEX_PATH)
+    def update(self, ids: List[int], embeddings: torch.FloatTensor, data_source_ids: List[int]):
+        embeddings = embeddings.cpu().numpy()
+        ids = np.array(ids, dtype=np.int64)
 
-    def remove(self, ids: torch.LongTensor):
-        self.index.remove_ids(torch.tensor(ids))
+        for data_source_id, positions in _group_positions(data_source_ids).items():
+            if data_source_id not in self.shards:
+                self.shards[data_source_id] = FaissShard(self._shard_path(data_source_id))
+            self.shards[data_source_id].add(ids[positions], embeddings[positions])
+            self.shards[data_source_id].save()
 
-        faiss.write_index(self.index, FAISS_INDEX_PATH)
+    def remove(self, ids: List[int], data_source_ids: List[int]):
+        ids = np.array(ids, dtype=np.int64)
 
-    def search(self, queries: torch.FloatTensor, top_k: int, *args, **kwargs):
+        for data_source_id, positions in _group_positions(data_source_ids).items():
+            if data_source_id not in self.shards:
+                continue
+            self.shards[data_source_id].remove(ids[positions])
+            self.shards[data_source_id].save()
+
+    def drop_shard(self, data_source_id: int):
+        shard = self.shards.pop(data_source_id, None)
+        if shard is not None:
+            shard.delete_files()
+
+    def search(self, queries: torch.FloatTensor, top_k: int, *args, allowed_ids: Optional[List[int]] = None,
+               data_source_ids: Optional[List[int]] = None, **kwargs):
+        """
+        data_source_ids restricts the search to the shards of the given data sources,
+        allowed_ids to the given paragraph ids, so filtered out vectors are never scored
+        """
         if queries.ndim == 1:
             queries = queries.unsqueeze(0)
-        _, ids = self.index.search(queries.cpu(), top_k, *args, **kwargs)
-        return ids
+        queries = queries.cpu().numpy()
+
+        if allowed_ids is not None:
+            selector = faiss.IDSelectorBatch(np.array(allowed_ids, dtype=np.int64))
+            kwargs['params'] = faiss.SearchParameters(sel=selector)
+
+        if data_source_ids is None:
+            shards = list(self.shards.values())
+        else:
+            shards = [self.shards[data_source_id] for data_source_id in data_source_ids
+                      if data_source_id in self.shards]
+        if len(shards) == 0:
+            return np.full((len(queries), top_k), -1, dtype=np.int64)
+
+        results = list(self._executor.map(lambda shard: shard.search(queries, top_k, *args, **kwargs), shards))
+
+        # merge the per shard results by inner product, missing results (-1) have the lowest scores
+        scores = np.concatenate([shard_scores for shard_scores, _ in results], axis=1)
+        ids = np.concatenate([shard_ids for _, shard_ids in results], axis=1)
+        best = np.argsort(-scores, axis=1)[:, :top_k]
+        return np.take_along_axis(ids, best, axis=1)
 
     def clear(self):
-        self.index.reset()
-        faiss.write_index(self.index, FAISS_INDEX_PATH)
+        for data_source_id in list(self.shards.keys()):
+            self.drop_shard(data_source_id)
+
+
+if __name__ == '__main__':
+    # Compares recall@k and memory of the quantized storages against IndexFlatIP,
+    # on the vectors of the existing shards or on random vectors if there are none
+    top_k = 10
+    vectors = [shard.index.index.reconstruct_n(0, shard.index.ntotal)
+               for shard in FaissIndex().shards.values() if not shard.is_quantized and shard.index.ntotal > 0]
+    if vectors:
+        vectors = np.concatenate(vectors)
+    else:
+        vectors = np.random.randn(100_000, MODEL_DIM).astype(np.float32)
+        faiss.normalize_L2(vectors)
+    queries = vectors[np.random.choice(len(vectors), min(200, len(vectors)), replace=False)]
+    queries = queries + np.random.randn(*queries.shape).astype(np.float32) * 0.05
+    faiss.normalize_L2(queries)
+    ids = np.arange(len(vectors), dtype=np.int64)
+
+    flat_index = _new_index('flat')
+    flat_index.add_with_ids(vectors, ids)
+    _, exact = flat_index.search(queries, top_k)
+
+    def recall_of(found: np.ndarray) -> float:
+        return np.mean([len(set(found[i]) & set(exact[i])) / top_k for i in range(len(queries))])
+
+    print(f'{len(vectors)} vectors, {len(queries)} queries, recall@{top_k} against IndexFlatIP')
+    for storage in ['flat', 'fp16', 'int8']:
+        index = _new_index(storage)
+        index.train(vectors)
+        index.add_with_ids(vectors, ids)
+        size_mb = len(faiss.serialize_index(index)) / 1024 / 1024
+
+        _, found = index.search(queries, top_k)
+        print(f'{storage}: {size_mb:.1f} MB, recall {recall_of(found):.4f}')
+
+        if storage != 'flat':
+            _, found = index.search(queries, top_k * RESCORE_FACTOR)
+            rescored = []
+            for i, query in enumerate(queries):
+                candidates = found[i][found[i] != -1]
+                best = candidates[np.argsort(-(vectors[candidates] @ query))[:top_k]]
+                rescored.append(len(set(best) & set(exact[i])) / top_k)
+            print(f'{storage} + rescoring: {size_mb:.1f} MB in memory '
+                  f'(+{vectors.nbytes / 1024 / 1024:.1f} MB memory mapped), recall {np.mean(rescored):.4f}')
+
+    # shards are trained once, on the vectors they hold when they are converted to int8
+    for training_size in [1, 20, 200, MIN_TRAINING_VECTORS]:
+        if training_size > len(vectors):
+            break
+        index = _new_index('int8')
+        index.train(vectors[:training_size])
+        index.add_with_ids(vectors, ids)
+        _, found = index.search(queries, top_k)
+        print(f'int8 trained on the first {training_size} vectors: recall {recall_of(found):.4f}')
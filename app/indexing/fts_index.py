@@ -0,0 +1,161 @@
+import json
+import re
+from typing import List, Optional
+
+from sqlalchemy import text
+
+from db_engine import Session
+from indexing.bm25_index import _add_metadata_for_indexing
+from schemas import Paragraph
+
+
+class FtsIndex:
+    """
+    Lexical index backed by an SQLite FTS5 virtual table living next to the `paragraph` table.
+    Unlike Bm25Index it is updated incrementally, stays on disk and can be queried from any process.
+    Deleting rows is cheap here, so a single table is shared by all data sources instead of shards.
+    """
+    instance = None
+
+    @staticmethod
+    def create():
+        if FtsIndex.instance is not None:
+            raise RuntimeError("Index is already initialized")
+
+        FtsIndex.instance = FtsIndex()
+
+    @staticmethod
+    def get() -> 'FtsIndex':
+        if FtsIndex.instance is None:
+            raise RuntimeError("Index is not initialized")
+        return FtsIndex.instance
+
+    def __init__(self) -> None:
+        with Session() as session:
+            session.execute(text("CREATE VIRTUAL TABLE IF NOT EXISTS paragraph_fts "
+                                 "USING fts5(content, tokenize='porter unicode61')"))
+            session.commit()
+
+    def rebuild(self):
+        """
+        Indexes all the paragraphs again, e.g. after another lexical backend was used
+        """
+        with Session() as session:
+            session.execute(text("DELETE FROM paragraph_fts"))
+            paragraphs = session.query(Paragraph).all()
+            if paragraphs:
+                self._add(paragraphs, session)
+            session.commit()
+
+    def _add(self, paragraphs: List[Paragraph], session):
+        session.execute(text("INSERT OR REPLACE INTO paragraph_fts (rowid, content) VALUES (:id, :content)"),
+                        [{'id': paragraph.id, 'content': _add_metadata_for_indexing(paragraph)}
+                         for paragraph in paragraphs])
+
+    def _remove(self, paragraphs: List[Paragraph], session):
+        session.execute(text("DELETE FROM paragraph_fts WHERE rowid = :id"),
+                        [{'id': paragraph.id} for paragraph in paragraphs])
+
+    def _drop_shard(self, data_source_id: int, session):
+        session.execute(text("DELETE FROM paragraph_fts WHERE rowid IN "
+                             "(SELECT paragraph.id FROM paragraph JOIN document ON paragraph.document_id = document.id "
+                             "WHERE document.data_source_id = :data_source_id)"),
+                        {'data_source_id': data_source_id})
+
+    def add(self, paragraphs: List[Paragraph], session=None):
+        if len(paragraphs) == 0:
+            return
+
+        if session is None:
+            with Session() as session:
+                self._add(paragraphs, session)
+                session.commit()
+        else:
+            self._add(paragraphs, session)
+
+    def remove(self, paragraphs: List[Paragraph], session=None):
+        if len(paragraphs) == 0:
+            return
+
+        if session is None:
+            with Session() as session:
+                self._remove(paragraphs, session)
+                session.commit()
+        else:
+            self._remove(paragraphs, session)
+
+    def drop_shard(self, data_source_id: int, session=None):
+        if session is None:
+            with Session() as session:
+                self._drop_shard(data_source_id, session)
+                session.commit()
+        else:
+            self._drop_shard(data_source_id, session)
+
+    @staticmethod
+    def _to_match_query(query: str) -> str:
+        # quote every term so user input can't be interpreted as FTS5 query syntax
+        terms = re.findall(r'\w+', query)
+        return ' OR '.join(f'"{term}"' for term in terms)
+
+    def search(self, query: str, top_k: int, allowed_ids: Optional[List[int]] = None,
+               data_source_ids: Optional[List[int]] = None) -> List[int]:
+        match_query = self._to_match_query(query)
+        if not match_query:
+            return []
+
+        sql = "SELECT rowid FROM paragraph_fts WHERE paragraph_fts MATCH :query"
+        params = {'query': match_query, 'top_k': top_k}
+        if data_source_ids is not None:
+            sql += (" AND rowid IN (SELECT paragraph.id FROM paragraph JOIN document "
+                    "ON paragraph.document_id = document.id "
+                    "WHERE document.data_source_id IN (SELECT value FROM json_each(:data_source_ids)))")
+            params['data_source_ids'] = json.dumps(data_source_ids)
+        if allowed_ids is not None:
+            # passed as a single json array to avoid sqlite's bound variables limit
+            sql += " AND rowid IN (SELECT value FROM json_each(:allowed_ids))"
+            params['allowed_ids'] = json.dumps(allowed_ids)
+        sql += " ORDER BY bm25(paragraph_fts) LIMIT :top_k"
+
+        with Session() as session:
+            rows = session.execute(text(sql), params)
+            return [row[0] for row in rows]
+
+    def clear(self):
+        with Session() as session:
+            session.execute(text("DELETE FROM paragraph_fts"))
+            session.commit()
+
+
+if __name__ == '__main__':
+    # Compares FtsIndex against Bm25Index on the paragraphs currently in the database
+    import sys
+    import time
+
+    from indexing.bm25_index import Bm25Index
+
+    queries = sys.argv[1:] or ['how to deploy', 'onboarding', 'database migration failed']
+
+    start = time.perf_counter()
+    Bm25Index.create()
+    bm25 = Bm25Index.get()
+    bm25.update()
+    print(f'Bm25Index build: {time.perf_counter() - start:.3f}s')
+
+    start = time.perf_counter()
+    FtsIndex.create()
+    fts = FtsIndex.get()
+    fts.rebuild()
+    print(f'FtsIndex build: {time.perf_counter() - start:.3f}s')
+
+    for backend_name, backend in [('bm25', bm25), ('fts5', fts)]:
+        start = time.perf_counter()
+        for query in queries:
+            backend.search(query, 20)
+        print(f'{backend_name} search: {(time.perf_counter() - start) / len(queries) * 1000:.2f}ms per query')
+
+    for query in queries:
+        bm25_ids = set(bm25.search(query, 20))
+        fts_ids = set(fts.search(query, 20))
+        overlap = len(bm25_ids & fts_ids) / max(len(bm25_ids), 1)
+        print(f'"{query}": top-20 overlap {overlap:.0%}')
@@ -1,13 +1,22 @@
+import hashlib
 import logging
+import os
 import re
+import time
 from enum import Enum
-from typing import List, Optional
+from typing import Dict, List, Optional
 
+import torch
+from sqlalchemy import update
+
+from answer_cache import AnswerCache
 from data_source.api.basic_document import BasicDocument, FileType
 from db_engine import Session
-from indexing.bm25_index import Bm25Index
+from indexing.embedding_pool import EmbeddingPool
 from indexing.faiss_index import FaissIndex
-from models import bi_encoder
+from indexing.lexical_index import get_lexical_index
+from indexing.sentences import sentence_offsets, encode_offsets
+from models import bi_encoder, BI_ENCODER_MODEL
 from parsers.pdf import split_PDF_into_paragraphs
 from paths import IS_IN_DOCKER
 from schemas import Document, Paragraph
@@ -16,6 +25,12 @@ from langchain.schema import Document as PDFDocument
 
 logger = logging.getLogger(__name__)
 
+BI_ENCODER_BATCH_SIZE = int(os.environ.get('BI_ENCODER_BATCH_SIZE', 32))
+# paragraphs are encoded in slices of this many batches, bounding the memory used by a single encode call
+BI_ENCODER_BATCHES_PER_SLICE = 8
+# short paragraphs are merged until they are longer than this
+PARAGRAPH_MIN_LENGTH = 256
+
 
 def get_enum_value_or_none(enum: Optional[Enum]) -> Optional[str]:
     if enum is None:
@@ -44,14 +59,67 @@ class Indexer:
             url=document.url,
             timestamp=document.timestamp,
             paragraphs=[
-                Paragraph(content=content)
+                Paragraph(content=content, sentence_offsets=encode_offsets(sentence_offsets(content)))
                 for content in paragraphs
             ],
             parent=parent
         )
 
     @staticmethod
-    def index_documents(documents: List[BasicDocument]):
+    def document_hash(document: BasicDocument) -> str:
+        fields = [document.type, document.title, document.content, document.author, document.author_image_url,
+                  document.location, document.url, document.status, document.is_active, document.file_type,
+                  document.timestamp]
+        digest = hashlib.sha1(repr(fields).encode())
+        for child in document.children or []:
+            digest.update(Indexer.document_hash(child).encode())
+        return digest.hexdigest()
+
+    @staticmethod
+    def _skip_unchanged_documents(documents: List[BasicDocument]) -> List[BasicDocument]:
+        """
+        Connectors re-emit documents that didn't change (e.g. merged chat messages), those are not re-indexed
+        """
+        hashes = {(document.data_source_id, document.id_in_data_source): Indexer.document_hash(document)
+                  for document in documents}
+        unchanged = set()
+        with Session() as session:
+            for data_source_id in {data_source_id for data_source_id, _ in hashes.keys()}:
+                ids_in_data_source = [id_in_data_source for key_data_source_id, id_in_data_source in hashes.keys()
+                                      if key_data_source_id == data_source_id]
+                rows = session.query(Document.id_in_data_source, Document.content_hash).filter(
+                    Document.data_source_id == data_source_id,
+                    Document.id_in_data_source.in_(ids_in_data_source), Document.parent_id.is_(None)).all()
+                unchanged.update((data_source_id, id_in_data_source) for id_in_data_source, stored_hash in rows
+                                 if stored_hash == hashes[(data_source_id, id_in_data_source)])
+
+        return [document for document in documents
+                if (document.data_source_id, document.id_in_data_source) not in unchanged]
+
+    @staticmethod
+    def _save_content_hashes(content_hashes: Dict[int, str]):
+        """
+        Saved once the documents are fully indexed, so documents whose indexing failed halfway
+        are indexed again by the retry instead of being skipped as unchanged
+        """
+        with Session() as session:
+            session.execute(update(Document), [dict(id=document_id, content_hash=content_hash)
+                                               for document_id, content_hash in content_hashes.items()])
+            session.commit()
+
+    @staticmethod
+    def index_documents(documents: List[BasicDocument]) -> int:
+        """
+        Returns the number of documents skipped because they didn't change since they were indexed
+        """
+        changed_documents = Indexer._skip_unchanged_documents(documents)
+        skipped_count = len(documents) - len(changed_documents)
+        if skipped_count > 0:
+            logger.info(f"Skipping {skipped_count} unchanged documents")
+        documents = changed_documents
+        if len(documents) == 0:
+            return skipped_count
+
         logger.info(f"Indexing {len(documents)} documents")
 
         ids_in_data_source = [document.id_in_data_source for document in documents]
@@ -70,6 +138,7 @@ class Indexer:
 
         with Session() as session:
             db_documents = []
+            top_level_documents = []
             for document in documents:
                 # Split the content into paragraphs that fit inside the database
                 paragraphs = Indexer._split_into_paragraphs(document.content)
@@ -78,42 +147,85 @@ class Indexer:
                 children = []
                 if document.children:
                     children = [Indexer.basic_to_document(child, db_document) for child in document.children]
+                top_level_documents.append(db_document)
                 db_documents.append(db_document)
                 db_documents.extend(children)
 
             # Save the documents to the database
             session.add_all(db_documents)
             session.commit()
+            content_hashes = {db_document.id: Indexer.document_hash(document)
+                              for db_document, document in zip(top_level_documents, documents)}
 
             # Create a list of all the paragraphs in the documents
             logger.info(f"Indexing {len(db_documents)} documents => {len(paragraphs)} paragraphs")
             paragraphs = [paragraph for document in db_documents for paragraph in document.paragraphs]
             if len(paragraphs) == 0:
                 logger.info(f"No paragraphs to index")
-                return
+                Indexer._save_content_hashes(content_hashes)
+                return skipped_count
 
             paragraph_ids = [paragraph.id for paragraph in paragraphs]
+            paragraph_data_source_ids = [paragraph.document.data_source_id for paragraph in paragraphs]
             paragraph_contents = [Indexer._add_metadata_for_indexing(paragraph) for paragraph in paragraphs]
 
-        logger.info(f"Updating BM25 index...")
-        Bm25Index.get().update()
-
-        if len(paragraph_contents) == 0:
-            return
+            logger.info(f"Updating lexical index...")
+            get_lexical_index().add(paragraphs, session=session)
+            session.commit()
 
         # Encode the paragraphs
-        show_progress_bar = not IS_IN_DOCKER
         logger.info(f"Encoding with bi-encoder...")
-        embeddings = bi_encoder.encode(paragraph_contents, convert_to_tensor=True, show_progress_bar=show_progress_bar)
+        embeddings = Indexer._encode(paragraph_contents)
 
         # Add the embeddings to the index
         logger.info(f"Updating Faiss index...")
-        FaissIndex.get().update(paragraph_ids, embeddings)
+        FaissIndex.get().update(paragraph_ids, embeddings, paragraph_data_source_ids)
+        Indexer._save_content_hashes(content_hashes)
 
         logger.info(f"Finished indexing {len(documents)} documents => {len(paragraphs)} paragraphs")
+        return skipped_count
 
     @staticmethod
-    def _split_into_paragraphs(text, minimum_length=256):
+    def _encode(contents: List[str]) -> torch.FloatTensor:
+        """
+        Encodes the contents sorted by length, so batches hold paragraphs of similar length,
+        and returns the embeddings in the original order.
+        """
+        show_progress_bar = not IS_IN_DOCKER
+        order = sorted(range(len(contents)), key=lambda i: len(contents[i]))
+        dimension = bi_encoder.get_sentence_embedding_dimension()
+
+        slice_size = BI_ENCODER_BATCH_SIZE * BI_ENCODER_BATCHES_PER_SLICE
+        slices = [order[start:start + slice_size] for start in range(0, len(order), slice_size)]
+
+        if pool := EmbeddingPool.get(BI_ENCODER_MODEL):
+            start_time = time.perf_counter()
+            embeddings, stats = pool.encode(contents, slices, dimension, BI_ENCODER_BATCH_SIZE)
+            for paragraphs_count, chars_count, elapsed in stats:
+                Indexer._log_encoding_throughput(paragraphs_count, chars_count, elapsed)
+            Indexer._log_encoding_throughput(len(contents), sum(len(content) for content in contents),
+                                             time.perf_counter() - start_time, prefix="Embedding pool encoded")
+            return embeddings
+
+        embeddings = torch.empty((len(contents), dimension))
+        for slice_order in slices:
+            slice_start_time = time.perf_counter()
+            slice_embeddings = bi_encoder.encode([contents[i] for i in slice_order], batch_size=BI_ENCODER_BATCH_SIZE,
+                                                 convert_to_tensor=True, show_progress_bar=show_progress_bar)
+            embeddings[slice_order] = slice_embeddings.cpu()
+            Indexer._log_encoding_throughput(len(slice_order), sum(len(contents[i]) for i in slice_order),
+                                             time.perf_counter() - slice_start_time)
+
+        return embeddings
+
+    @staticmethod
+    def _log_encoding_throughput(paragraphs_count: int, chars_count: int, elapsed: float, prefix="Encoded"):
+        elapsed = max(elapsed, 1e-6)
+        logger.info(f"{prefix} {paragraphs_count} paragraphs ({chars_count} chars) in {elapsed:.2f}s "
+                    f"({paragraphs_count / elapsed:.1f} paragraphs/s, {chars_count / elapsed:.0f} chars/s)")
+
+    @staticmethod
+    def _split_into_paragraphs(text, minimum_length=PARAGRAPH_MIN_LENGTH):
         """
         split into paragraphs and batch small paragraphs together into the same paragraph
         """
@@ -150,11 +262,20 @@ class Indexer:
 
         # Remove the paragraphs from the index
         paragraph_ids = [paragraph.id for paragraph in db_paragraphs]
+        paragraph_data_source_ids = [paragraph.document.data_source_id for paragraph in db_paragraphs]
 
         logger.info(f"Removing documents from faiss index...")
-        FaissIndex.get().remove(paragraph_ids)
+        FaissIndex.get().remove(paragraph_ids, paragraph_data_source_ids)
 
-        logger.info(f"Removing documents from BM25 index...")
-        Bm25Index.get().update(session=session)
+        logger.info(f"Removing documents from lexical index...")
+        get_lexical_index().remove(db_paragraphs, session=session)
+        AnswerCache.invalidate(paragraph_ids, session=session)
 
         logger.info(f"Finished removing {len(documents)} documents => {len(db_paragraphs)} paragraphs")
+
+    @staticmethod
+    def remove_data_source(data_source_id: int, session=None):
+        logger.info(f"Dropping index shards of data source {data_source_id}")
+        FaissIndex.get().drop_shard(data_source_id)
+        get_lexical_index().drop_shard(data_source_id, session=session)
+        AnswerCache.invalidate_data_source(data_source_id, session=session)
@@ -0,0 +1,49 @@
+import logging
+import os
+from typing import Union
+
+from indexing.bm25_index import Bm25Index
+from indexing.fts_index import FtsIndex
+from paths import LEXICAL_INDEX_BACKEND_PATH
+
+# 'bm25' keeps a pickled in-memory index, 'fts5' uses an SQLite FTS5 table on disk
+LEXICAL_INDEX_BACKEND = os.environ.get('LEXICAL_INDEX_BACKEND', 'bm25')
+
+_BACKENDS = {
+    'bm25': Bm25Index,
+    'fts5': FtsIndex,
+}
+
+logger = logging.getLogger(__name__)
+
+
+def _backend_class():
+    if LEXICAL_INDEX_BACKEND not in _BACKENDS:
+        raise RuntimeError(f"Unknown lexical index backend {LEXICAL_INDEX_BACKEND}, "
+                           f"expected one of {list(_BACKENDS.keys())}")
+    return _BACKENDS[LEXICAL_INDEX_BACKEND]
+
+
+def _get_last_backend() -> str:
+    if not os.path.exists(LEXICAL_INDEX_BACKEND_PATH):
+        # saved since the fts5 backend was added, older installs only had bm25
+        return 'bm25'
+    with open(LEXICAL_INDEX_BACKEND_PATH) as f:
+        return f.read().strip()
+
+
+def create_lexical_index():
+    backend_class = _backend_class()
+    backend_class.create()
+
+    # only the backend in use is updated, the other one is stale by the time it's switched back to
+    last_backend = _get_last_backend()
+    if last_backend != LEXICAL_INDEX_BACKEND:
+        logger.info(f"Lexical index backend changed from {last_backend} to {LEXICAL_INDEX_BACKEND}, rebuilding it")
+        backend_class.get().rebuild()
+        with open(LEXICAL_INDEX_BACKEND_PATH, 'w') as f:
+            f.write(LEXICAL_INDEX_BACKEND)
+
+
+def get_lexical_index() -> Union[Bm25Index, FtsIndex]:
+    return _backend_class().get()
@@ -0,0 +1,44 @@
+import re
+import struct
+from bisect import bisect_right
+from typing import List, Optional, Tuple
+
+SENTENCE_DELIMITER = re.compile(r'[\.\!\?\:\-] |[\"“\(\)]')
+
+
+def sentence_offsets(text: str) -> List[int]:
+    """
+    Returns the start offset of every sentence in the text
+    """
+    offsets = [0]
+    for match in SENTENCE_DELIMITER.finditer(text):
+        if match.end() < len(text) and match.end() != offsets[-1]:
+            offsets.append(match.end())
+    return offsets
+
+
+def encode_offsets(offsets: List[int]) -> bytes:
+    return struct.pack(f'<{len(offsets)}I', *offsets)
+
+
+def decode_offsets(data: Optional[bytes]) -> Optional[List[int]]:
+    if data is None:
+        return None
+    return list(struct.unpack(f'<{len(data) // 4}I', data))
+
+
+def sentence_span(text: str, offsets: List[int], start: int, end: int) -> Tuple[int, int]:
+    """
+    Returns the span of the sentence containing text[start:end],
+    or (start, end) itself if it crosses a sentence boundary.
+    """
+    index = bisect_right(offsets, start) - 1
+    if index + 1 < len(offsets) and end > offsets[index + 1]:
+        return start, end
+
+    sentence_start = offsets[index]
+    sentence_end = offsets[index + 1] if index + 1 < len(offsets) else len(text)
+    # leave out the whitespace and quotes/brackets that ended the sentence
+    while sentence_end > sentence_start and (text[sentence_end - 1].isspace() or text[sentence_end - 1] in '"“()'):
+        sentence_end -= 1
+    return sentence_start, sentence_end
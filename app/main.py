@@ -8,15 +8,18 @@ from fastapi.middleware.cors import CORSMiddleware
 from fastapi_restful.tasks import repeat_every
 from starlette.responses import Response, FileResponse
 
+from answer_cache import AnswerCache
 from api.data_source import router as data_source_router
 from api.search import router as search_router
 from data_source.api.exception import KnownException
+from data_source.api.async_runtime import AsyncRuntime
 from data_source.api.context import DataSourceContext
 from data_source.api.utils import get_utc_time_now
 from db_engine import Session
 from indexing.background_indexer import BackgroundIndexer
-from indexing.bm25_index import Bm25Index
+from indexing.embedding_pool import EmbeddingPool
 from indexing.faiss_index import FaissIndex
+from indexing.lexical_index import create_lexical_index, get_lexical_index
 from queues.index_queue import IndexQueue
 from paths import UI_PATH
 from queues.task_queue import TaskQueue
@@ -100,7 +103,7 @@ async def startup_event():
     if not torch.cuda.is_available():
         logger.warning("CUDA is not available, using CPU. This will make indexing and search very slow!!!")
     FaissIndex.create()
-    Bm25Index.create()
+    create_lexical_index()
     DataSourceContext.init()
     BackgroundIndexer.start()
     Workers.start()
@@ -109,7 +112,9 @@ async def startup_event():
 @app.on_event("shutdown")
 async def shutdown_event():
     Workers.stop()
+    AsyncRuntime.stop()
     BackgroundIndexer.stop()
+    EmbeddingPool.stop()
 
 
 @app.get("/api/v1/status")
@@ -119,19 +124,24 @@ def status():
         docs_in_indexing: int
         docs_left_to_index: int
         docs_indexed: int
+        docs_skipped_unchanged: int
+        indexing_docs_per_second: float
 
     return Status(docs_in_indexing=BackgroundIndexer.get_currently_indexing(),
                   docs_left_to_index=IndexQueue.get_instance().qsize() + TaskQueue.get_instance().qsize(),
-                  docs_indexed=BackgroundIndexer.get_indexed_count())
+                  docs_indexed=BackgroundIndexer.get_indexed_count(),
+                  docs_skipped_unchanged=BackgroundIndexer.get_skipped_count(),
+                  indexing_docs_per_second=BackgroundIndexer.get_docs_per_second())
 
 
 @app.post("/clear-index")
 async def clear_index():
     FaissIndex.get().clear()
-    Bm25Index.get().clear()
+    get_lexical_index().clear()
     with Session() as session:
         session.query(Document).delete()
         session.query(Paragraph).delete()
+        AnswerCache.clear(session)
         session.commit()
 
 
@@ -1,11 +1,18 @@
+import os
+
 from sentence_transformers import SentenceTransformer, CrossEncoder
 from transformers import pipeline
 import torch
 
+# inputs longer than these (in tokens) are truncated, lower them to trade accuracy for CPU time
+CROSS_ENCODER_MAX_LENGTH = int(os.environ.get('CROSS_ENCODER_MAX_LENGTH', 512))
+QA_MAX_SEQ_LENGTH = int(os.environ.get('QA_MAX_SEQ_LENGTH', 384))
+
+BI_ENCODER_MODEL = 'multi-qa-MiniLM-L6-cos-v1'
 
-bi_encoder = SentenceTransformer('multi-qa-MiniLM-L6-cos-v1')
+bi_encoder = SentenceTransformer(BI_ENCODER_MODEL)
 
-cross_encoder_small = CrossEncoder('cross-encoder/ms-marco-TinyBERT-L-2-v2')
-cross_encoder_large = CrossEncoder('cross-encoder/ms-marco-MiniLM-L-6-v2')
+cross_encoder_small = CrossEncoder('cross-encoder/ms-marco-TinyBERT-L-2-v2', max_length=CROSS_ENCODER_MAX_LENGTH)
+cross_encoder_large = CrossEncoder('cross-encoder/ms-marco-MiniLM-L-6-v2', max_length=CROSS_ENCODER_MAX_LENGTH)
 
 qa_model = pipeline('question-answering', model='deepset/roberta-base-squad2')
@@ -17,4 +17,11 @@ SQLITE_TASKS_PATH = STORAGE_PATH / 'tasks.sqlite3'
 SQLITE_INDEXING_PATH = STORAGE_PATH / 'indexing.sqlite3'
 FAISS_INDEX_PATH = str(STORAGE_PATH / 'faiss_index.bin')
 BM25_INDEX_PATH = str(STORAGE_PATH / 'bm25_index.bin')
+FAISS_SHARDS_PATH = STORAGE_PATH / 'faiss_shards'
+BM25_SHARDS_PATH = STORAGE_PATH / 'bm25_shards'
 UUID_PATH = str(STORAGE_PATH / '.uuid')
+LEXICAL_INDEX_BACKEND_PATH = str(STORAGE_PATH / 'lexical_index_backend')
+
+for shards_path in [FAISS_SHARDS_PATH, BM25_SHARDS_PATH]:
+    if not shards_path.exists():
+        shards_path.mkdir(parents=True)
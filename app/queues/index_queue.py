@@ -1,11 +1,12 @@
 import threading
 from dataclasses import dataclass
-from typing import List
+from typing import Callable, List, Optional
 
-from persistqueue import SQLiteAckQueue
+from persistqueue import SQLiteAckQueue, Empty
 
 from data_source.api.basic_document import BasicDocument
 from paths import SQLITE_INDEXING_PATH
+from queues.notifier import QueueNotifier
 
 
 @dataclass
@@ -29,28 +30,60 @@ class IndexQueue(SQLiteAckQueue):
         if IndexQueue._instance is not None:
             raise RuntimeError("Queue is a singleton, use .get() to get the instance")
 
-        self.condition = threading.Condition()
+        self.notifier = QueueNotifier(SQLITE_INDEXING_PATH / 'notify.sock')
         super().__init__(path=SQLITE_INDEXING_PATH, multithreading=True, name="index")
 
     def put_single(self, doc: BasicDocument):
         self.put([doc])
 
     def put(self, docs: List[BasicDocument]):
-        with self.condition:
-            for doc in docs:
-                super().put(doc)
+        for doc in docs:
+            super().put(doc)
 
-            self.condition.notify_all()
+        self.notifier.notify()
 
-    def consume_all(self, max_docs=5000, timeout=1) -> List[IndexQueueItem]:
-        with self.condition:
-            self.condition.wait(timeout=timeout)
+    def wake_up(self):
+        """
+        Makes the thread waiting in consume_all return
+        """
+        self.notifier.notify()
 
-            queue_items = []
-            count = 0
-            while not super().empty() and count < max_docs:
-                raw_item = super().get(raw=True)
-                queue_items.append(IndexQueueItem(queue_item_id=raw_item['pqid'], doc=raw_item['data']))
-                count += 1
+    @staticmethod
+    def _content_size(doc: BasicDocument) -> int:
+        size = len(doc.content or '')
+        for child in doc.children or []:
+            size += IndexQueue._content_size(child)
+        return size
 
-            return queue_items
+    def _consume(self, max_docs: int, max_size: Optional[int],
+                 size_of: Callable[[BasicDocument], int]) -> List[IndexQueueItem]:
+        queue_items = []
+        size = 0
+        while len(queue_items) < max_docs:
+            if max_size is not None and size >= max_size:
+                break
+
+            try:
+                # reads the database rather than the in-memory size, which misses documents put by other processes
+                raw_item = super().get(raw=True, block=False)
+            except Empty:
+                break
+            queue_items.append(IndexQueueItem(queue_item_id=raw_item['pqid'], doc=raw_item['data']))
+            size += size_of(raw_item['data'])
+
+        return queue_items
+
+    def consume_all(self, max_docs=5000, timeout: Optional[float] = None, max_size: Optional[int] = None,
+                    size_of: Optional[Callable[[BasicDocument], int]] = None) -> List[IndexQueueItem]:
+        """
+        Consumes up to max_docs documents, stopping early once their size reaches max_size.
+        The size of a document is given by size_of, its content length in characters by default.
+        If the queue is empty, waits until documents are put, the timeout passes or wake_up is called.
+        """
+        size_of = size_of or self._content_size
+        generation = self.notifier.generation
+        queue_items = self._consume(max_docs, max_size, size_of)
+        if not queue_items and self.notifier.wait(generation, timeout=timeout):
+            queue_items = self._consume(max_docs, max_size, size_of)
+
+        return queue_items
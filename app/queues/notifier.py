@@ -0,0 +1,112 @@
+import logging
+import os
+import socket
+import threading
+from pathlib import Path
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+
+class QueueNotifier:
+    """
+    Wakes up the consumers of a queue when items are added, instead of having them poll the queue.
+    Producers in the same process notify through a condition variable. Producers in other processes
+    send a datagram to a unix socket that the consuming process listens on.
+    """
+
+    def __init__(self, socket_path: Path) -> None:
+        self._socket_path = str(socket_path)
+        self._condition = threading.Condition()
+        self._generation = 0
+        self._listener: Optional[socket.socket] = None
+        self._sender: Optional[socket.socket] = None
+        self._is_listened_elsewhere = False
+
+    @property
+    def generation(self) -> int:
+        """
+        Read before checking the queue and passed to wait(), so a notification in between isn't missed
+        """
+        return self._generation
+
+    def notify(self):
+        with self._condition:
+            self._generation += 1
+            self._condition.notify_all()
+
+        if self._listener is None:
+            self._notify_other_processes()
+
+    def wait(self, generation: int, timeout: Optional[float] = None) -> bool:
+        """
+        Returns whether a notification arrived since generation was read
+        """
+        self._listen()
+        with self._condition:
+            return self._condition.wait_for(lambda: self._generation != generation, timeout=timeout)
+
+    def _notify_other_processes(self):
+        if not hasattr(socket, 'AF_UNIX') or not os.path.exists(self._socket_path):
+            return
+
+        try:
+            if self._sender is None:
+                self._sender = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+                self._sender.setblocking(False)
+            self._sender.sendto(b'1', self._socket_path)
+        except OSError:
+            # nobody is listening, or the listener is busy and already has notifications to read
+            pass
+
+    def _listen(self):
+        if self._listener is not None or not hasattr(socket, 'AF_UNIX'):
+            return
+
+        with self._condition:
+            if self._listener is not None:
+                return
+
+            if os.path.exists(self._socket_path):
+                if self._is_socket_alive():
+                    # another process consumes the queue and keeps its socket, checked again on the next wait
+                    if not self._is_listened_elsewhere:
+                        logger.warning(f'Another process listens on {self._socket_path}, '
+                                       f'only notifications from this process will wake it up')
+                        self._is_listened_elsewhere = True
+                    return
+                # a socket left over by a process that died
+                os.remove(self._socket_path)
+
+            listener = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            try:
+                listener.bind(self._socket_path)
+            except OSError as e:
+                logger.warning(f'Could not listen for queue notifications from other processes: {e}')
+                listener.close()
+                return
+
+            self._listener = listener
+            threading.Thread(target=self._receive, daemon=True).start()
+
+    def _is_socket_alive(self) -> bool:
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        try:
+            # refused when no socket is bound to the path anymore
+            probe.connect(self._socket_path)
+            return True
+        except OSError:
+            return False
+        finally:
+            probe.close()
+
+    def _receive(self):
+        while True:
+            try:
+                self._listener.recv(16)
+            except OSError:
+                return
+
+            with self._condition:
+                self._generation += 1
+                self._condition.notify_all()
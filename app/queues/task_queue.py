@@ -1,10 +1,38 @@
+import dataclasses
+import hashlib
+import json
 import threading
+import time
 from dataclasses import dataclass
-from typing import Optional
+from datetime import date
+from enum import IntEnum
+from typing import Optional, Callable, Iterable, Any
 
 from persistqueue import SQLiteAckQueue, Empty
+from persistqueue.sqlackqueue import AckStatus
+from pydantic import BaseModel
 
 from paths import SQLITE_TASKS_PATH
+from queues.notifier import QueueNotifier
+
+
+class TaskPriority(IntEnum):
+    """
+    Lower values are served first
+    """
+    INCREMENTAL = 0
+    INTERACTIVE = 1
+    BACKFILL = 2
+
+
+def _to_json_compatible(value: Any) -> Any:
+    if isinstance(value, BaseModel):
+        return value.dict()
+    if dataclasses.is_dataclass(value):
+        return dataclasses.asdict(value)
+    if isinstance(value, date):
+        return value.isoformat()
+    return repr(value)
 
 
 @dataclass
@@ -13,6 +41,15 @@ class Task:
     function_name: str
     kwargs: dict
     attempts: int = 3
+    priority: TaskPriority = TaskPriority.INCREMENTAL
+    # equal for tasks doing the same work, see TaskQueue.add_task
+    idempotency_key: Optional[str] = None
+
+    def __post_init__(self):
+        if self.idempotency_key is None:
+            stable_kwargs = json.dumps(self.kwargs, sort_keys=True, default=_to_json_compatible)
+            key = f'{self.data_source_id}:{self.function_name}:{stable_kwargs}'
+            self.idempotency_key = hashlib.sha1(key.encode()).hexdigest()
 
 
 @dataclass
@@ -22,8 +59,36 @@ class TaskQueueItem:
 
 
 class TaskQueue(SQLiteAckQueue):
+    """
+    Serves the tasks of the highest priority first, and within a priority takes turns between the data sources,
+    so a large backfill of one data source doesn't starve the others.
+    The priority and data source are stored in their own columns, so the order survives restarts.
+    A task is not added again while a task with the same idempotency key is queued or running.
+    """
     _instance = None
     _lock = threading.Lock()
+    # excluded data sources become available again without any notification, so they are checked this often
+    EXCLUDED_RECHECK_SECONDS = 1
+
+    _SQL_CREATE = (
+        'CREATE TABLE IF NOT EXISTS {table_name} ('
+        '{key_column} INTEGER PRIMARY KEY AUTOINCREMENT, '
+        'data BLOB, timestamp FLOAT, status INTEGER, '
+        f'priority INTEGER DEFAULT {TaskPriority.INCREMENTAL.value}, data_source_id INTEGER DEFAULT 0, '
+        'idempotency_key TEXT)'
+    )
+    _SQL_INSERT = (
+        'INSERT INTO {table_name} (data, timestamp, status, priority, data_source_id, idempotency_key)'
+        ' VALUES (?, ?, %s, ?, ?, ?)' % AckStatus.inited
+    )
+    # the next data source after the last served one, wrapping around to the lowest id
+    _SQL_SELECT = (
+        'SELECT {key_column}, data, timestamp, status FROM {table_name} '
+        'WHERE status < %s {exclude} '
+        'AND priority = (SELECT MIN(priority) FROM {table_name} WHERE status < %s {exclude}) '
+        'ORDER BY data_source_id <= {last_data_source_id}, data_source_id, {key_column} ASC LIMIT 1'
+        % (AckStatus.unack, AckStatus.unack)
+    )
 
     @classmethod
     def get_instance(cls):
@@ -36,16 +101,111 @@ class TaskQueue(SQLiteAckQueue):
         if TaskQueue._instance is not None:
             raise RuntimeError("TaskQueue is a singleton, use .get() to get the instance")
 
-        self.condition = threading.Condition()
+        self.notifier = QueueNotifier(SQLITE_TASKS_PATH / 'notify.sock')
+        self._last_data_source_id = -1
+        self._get_excluded_data_sources: Optional[Callable[[], Iterable[int]]] = None
+        self._has_excluded_data_sources = False
+        self._add_lock = threading.Lock()
         super().__init__(path=SQLITE_TASKS_PATH, multithreading=True, name="task")
 
+    def _init(self) -> None:
+        super()._init()
+        # tables created by older versions have no priority columns, their tasks are served as incremental
+        columns = {row[1] for row in self._conn.execute(f'PRAGMA table_info({self._table_name})')}
+        if 'priority' not in columns:
+            self._conn.execute(f'ALTER TABLE {self._table_name} ADD COLUMN priority INTEGER '
+                               f'DEFAULT {TaskPriority.INCREMENTAL.value}')
+        if 'data_source_id' not in columns:
+            self._conn.execute(f'ALTER TABLE {self._table_name} ADD COLUMN data_source_id INTEGER DEFAULT 0')
+        if 'idempotency_key' not in columns:
+            self._conn.execute(f'ALTER TABLE {self._table_name} ADD COLUMN idempotency_key TEXT')
+        self._conn.execute(f'CREATE INDEX IF NOT EXISTS `{self._TABLE_NAME}_{self.name}_priority` '
+                           f'ON {self._table_name} (status, priority, data_source_id, {self._key_column})')
+        self._conn.execute(f'CREATE INDEX IF NOT EXISTS `{self._TABLE_NAME}_{self.name}_idempotency_key` '
+                           f'ON {self._table_name} (idempotency_key, status)')
+        self._conn.commit()
+
+    def exclude_data_sources(self, get_excluded_data_sources: Callable[[], Iterable[int]]):
+        """
+        The tasks of the data sources returned by get_excluded_data_sources are left in the queue
+        """
+        self._get_excluded_data_sources = get_excluded_data_sources
+
+    def _sql_select(self, rowid) -> str:
+        exclude = ''
+        self._has_excluded_data_sources = False
+        if self._get_excluded_data_sources is not None:
+            if excluded := self._get_excluded_data_sources():
+                exclude = f'AND data_source_id NOT IN ({", ".join(str(int(id)) for id in excluded)})'
+                self._has_excluded_data_sources = True
+
+        return self._SQL_SELECT.format(table_name=self._table_name, key_column=self._key_column,
+                                       last_data_source_id=int(self._last_data_source_id), exclude=exclude)
+
+    def _find_pending(self, idempotency_key: str) -> Optional[tuple]:
+        """
+        Returns (id, status, priority) of a queued or running task with the given key
+        """
+        sql = (f'SELECT {self._key_column}, status, priority FROM {self._table_name} '
+               f'WHERE idempotency_key = ? AND status <= ? LIMIT 1')
+        return self._getter.execute(sql, (idempotency_key, AckStatus.unack)).fetchone()
+
+    def put(self, task: Task) -> Optional[int]:
+        """
+        Returns the id of the added task, or None if the task was coalesced into a pending one
+        """
+        with self._add_lock:
+            if pending := self._find_pending(task.idempotency_key):
+                pending_id, status, priority = pending
+                if int(status) < int(AckStatus.unack) and int(task.priority) < priority:
+                    # e.g. a forced re-index of a location whose backfill task didn't start yet
+                    self._update_priority(pending_id, task.priority)
+                return None
+
+            _id = self._insert_into(self._serializer.dumps(task), time.time(), int(task.priority),
+                                    task.data_source_id, task.idempotency_key)
+            self.total += 1
+        self.put_event.set()
+        self.notifier.notify()
+        return _id
+
+    def _update_priority(self, queue_item_id: int, priority: TaskPriority):
+        row = self._getter.execute(f'SELECT data FROM {self._table_name} WHERE {self._key_column} = ?',
+                                   (queue_item_id,)).fetchone()
+        task: Task = self._serializer.loads(row[0])
+        # the task keeps its priority too, so the tasks it adds inherit the new one
+        task.priority = priority
+        with self.tran_lock:
+            with self._putter as tran:
+                tran.execute(f'UPDATE {self._table_name} SET priority = ?, data = ? WHERE {self._key_column} = ?',
+                             (int(priority), self._serializer.dumps(task), queue_item_id))
+
     def add_task(self, task: Task):
         self.put(task)
 
-    def get_task(self, timeout=1) -> Optional[TaskQueueItem]:
-        try:
-            raw_item = super().get(raw=True, block=True, timeout=timeout)
-            return TaskQueueItem(queue_item_id=raw_item['pqid'], task=raw_item['data'])
+    def nack(self, *args, **kwargs) -> Optional[int]:
+        _id = super().nack(*args, **kwargs)
+        self.notifier.notify()
+        return _id
+
+    def wake_up(self):
+        """
+        Makes the threads waiting in get_task return
+        """
+        self.notifier.notify()
 
+    def get_task(self, timeout: Optional[float] = None) -> Optional[TaskQueueItem]:
+        """
+        Waits until a task is added, returns None if the wait timed out or the queue was woken up without a task
+        """
+        generation = self.notifier.generation
+        try:
+            raw_item = super().get(raw=True, block=False)
         except Empty:
+            if self._has_excluded_data_sources:
+                timeout = min(timeout or self.EXCLUDED_RECHECK_SECONDS, self.EXCLUDED_RECHECK_SECONDS)
+            self.notifier.wait(generation, timeout=timeout)
             return None
+
+        self._last_data_source_id = raw_item['data'].data_source_id
+        return TaskQueueItem(queue_item_id=raw_item['pqid'], task=raw_item['data'])
@@ -2,3 +2,6 @@ from schemas.data_source_type import DataSourceType
 from schemas.data_source import DataSource
 from schemas.document import Document
 from schemas.paragraph import Paragraph
+from schemas.cached_answer import CachedAnswer
+from schemas.location_cursor import LocationCursor
+from schemas.slack_user import SlackUser
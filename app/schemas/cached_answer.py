@@ -0,0 +1,17 @@
+from sqlalchemy import String, Integer, DateTime, UniqueConstraint
+from sqlalchemy.orm import Mapped, mapped_column
+
+from schemas.base import Base
+
+
+class CachedAnswer(Base):
+    __tablename__ = 'cached_answer'
+    __table_args__ = (UniqueConstraint('query', 'paragraph_id'),)
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    query: Mapped[str] = mapped_column(String(512))
+    paragraph_id: Mapped[int] = mapped_column(Integer(), index=True)
+    content_hash: Mapped[str] = mapped_column(String(40))
+    answer_start: Mapped[int] = mapped_column(Integer())
+    answer_end: Mapped[int] = mapped_column(Integer())
+    last_used_at: Mapped[DateTime] = mapped_column(DateTime(), index=True)
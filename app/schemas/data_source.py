@@ -21,6 +21,8 @@ class DataSource(Base):
     last_indexed_at: Mapped[Optional[DateTime]] = mapped_column(DateTime())
     created_at: Mapped[Optional[DateTime]] = mapped_column(DateTime())
     documents = relationship("Document", back_populates="data_source", cascade='all, delete, delete-orphan')
+    location_cursors = relationship("LocationCursor", back_populates="data_source",
+                                    cascade='all, delete, delete-orphan')
 
 
 @event.listens_for(DataSource, 'before_delete')
@@ -31,4 +33,4 @@ def receive_before_delete(mapper, connection: Connection, target):
 
     with Session(bind=connection) as session:
         logger.info(f"Deleting documents for data source {target.id}...")
-        Indexer.remove_documents(target.documents, session=session)
+        Indexer.remove_data_source(target.id, session=session)
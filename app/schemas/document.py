@@ -25,6 +25,8 @@ class Document(Base):
     url: Mapped[Optional[str]] = mapped_column(String(512))
     location: Mapped[Optional[str]] = mapped_column(String(512))
     timestamp: Mapped[Optional[DateTime]] = mapped_column(DateTime())
+    # hash of the indexed content and metadata, including the children, see Indexer.document_hash
+    content_hash: Mapped[Optional[str]] = mapped_column(String(40))
     paragraphs = relationship("Paragraph", back_populates="document", cascade='all, delete, delete-orphan',
                               foreign_keys="Paragraph.document_id")
 
@@ -0,0 +1,16 @@
+from sqlalchemy import String, DateTime, ForeignKey, Column, Integer, UniqueConstraint
+from sqlalchemy.orm import Mapped, mapped_column, relationship
+
+from schemas.base import Base
+
+
+class LocationCursor(Base):
+    __tablename__ = 'location_cursor'
+    __table_args__ = (UniqueConstraint('data_source_id', 'location'),)
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    data_source_id = Column(Integer, ForeignKey('data_source.id'), index=True)
+    data_source = relationship("DataSource", back_populates="location_cursors")
+    location: Mapped[str] = mapped_column(String(512))
+    cursor: Mapped[str] = mapped_column(String(512))
+    updated_at: Mapped[DateTime] = mapped_column(DateTime())
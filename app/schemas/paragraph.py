@@ -1,5 +1,7 @@
 from schemas.base import Base
-from sqlalchemy import String, ForeignKey, Column, Integer
+from typing import Optional
+
+from sqlalchemy import String, ForeignKey, Column, Integer, LargeBinary
 from sqlalchemy.orm import Mapped, mapped_column, relationship
 
 
@@ -8,6 +10,8 @@ class Paragraph(Base):
 
     id: Mapped[int] = mapped_column(primary_key=True)
     content: Mapped[str] = mapped_column(String(2048))
+    # start offset of every sentence in content, see indexing/sentences.py
+    sentence_offsets: Mapped[Optional[bytes]] = mapped_column(LargeBinary())
 
     document_id = Column(Integer, ForeignKey('document.id'))
     document = relationship("Document", back_populates="paragraphs")
@@ -0,0 +1,19 @@
+from sqlalchemy import String, DateTime, UniqueConstraint
+from sqlalchemy.orm import Mapped, mapped_column
+
+from schemas.base import Base
+
+
+class SlackUser(Base):
+    """
+    Users of a Slack workspace, shared by all the data sources of the workspace
+    """
+    __tablename__ = 'slack_user'
+    __table_args__ = (UniqueConstraint('team_id', 'user_id'),)
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    team_id: Mapped[str] = mapped_column(String(32), index=True)
+    user_id: Mapped[str] = mapped_column(String(32))
+    name: Mapped[str] = mapped_column(String(256))
+    image_url: Mapped[str] = mapped_column(String(512))
+    updated_at: Mapped[DateTime] = mapped_column(DateTime())
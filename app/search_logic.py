@@ -1,29 +1,49 @@
+import dataclasses
 import datetime
 import json
 import logging
+import os
 import re
 import urllib.parse
 from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
-from typing import List
+from enum import Enum
+from typing import List, Iterator, Tuple, Dict
 from typing import Optional
 
 import nltk
 import torch
 from sentence_transformers import CrossEncoder
+from sqlalchemy import func
 
+from answer_cache import AnswerCache
 from data_source.api.basic_document import DocumentType, FileType, DocumentStatus
 from data_source.api.utils import get_confluence_user_image
 from db_engine import Session
-from indexing.bm25_index import Bm25Index
 from indexing.faiss_index import FaissIndex
-from models import bi_encoder, cross_encoder_small, cross_encoder_large, qa_model
-from schemas import Paragraph, Document
+from indexing.lexical_index import get_lexical_index
+from indexing.sentences import sentence_offsets, decode_offsets, sentence_span
+from models import bi_encoder, cross_encoder_small, cross_encoder_large, qa_model, QA_MAX_SEQ_LENGTH
+from schemas import Paragraph, Document, DataSource, DataSourceType
 from util import threaded_method
 
 BM_25_CANDIDATES = 100 if torch.cuda.is_available() else 20
 BI_ENCODER_CANDIDATES = 60 if torch.cuda.is_available() else 20
 SMALL_CROSS_ENCODER_CANDIDATES = 30 if torch.cuda.is_available() else 10
+CROSS_ENCODER_BATCH_SIZE = 32
+QA_BATCH_SIZE = 8
+# what the QA model reads from every candidate: 'paragraph' (all of it), or just the best few sentence windows
+# picked by 'lexical' overlap with the query or by the large 'cross_encoder'
+QA_CONTEXT_MODES = ['paragraph', 'lexical', 'cross_encoder']
+QA_CONTEXT_MODE = os.environ.get('QA_CONTEXT_MODE', 'paragraph')
+if QA_CONTEXT_MODE not in QA_CONTEXT_MODES:
+    raise RuntimeError(f"Unknown QA context mode {QA_CONTEXT_MODE}, expected one of {QA_CONTEXT_MODES}")
+QA_WINDOW_SENTENCES = 3
+QA_WINDOWS_PER_PARAGRAPH = 2
+# filters matching more paragraphs than this are applied to the retrieved candidates instead of inside the indexes,
+# which retrieve POST_FILTER_CANDIDATES_FACTOR times more candidates to make up for the filtered out ones
+MAX_ALLOWED_IDS = 10_000
+POST_FILTER_CANDIDATES_FACTOR = 4
 
 nltk.download('punkt')
 logger = logging.getLogger(__name__)
@@ -54,6 +74,27 @@ class SearchResult:
     child: Optional['SearchResult'] = None
 
 
+class SearchStage(Enum):
+    # fused vector & lexical retrieval reranked by the small cross-encoder
+    PRELIMINARY = "preliminary"
+    # reranked by the large cross-encoder
+    REFINED = "refined"
+    # answers highlighted and reranked by answer
+    FINAL = "final"
+
+
+@dataclass
+class SearchFilters:
+    data_sources: Optional[List[str]] = None
+    types: Optional[List[DocumentType]] = None
+    statuses: Optional[List[str]] = None
+    after: Optional[datetime.datetime] = None
+    before: Optional[datetime.datetime] = None
+
+    def is_empty(self) -> bool:
+        return not (self.data_sources or self.types or self.statuses or self.after or self.before)
+
+
 @dataclass
 class Candidate:
     content: str
@@ -61,13 +102,12 @@ class Candidate:
     document: Document = None
     answer_start: int = -1
     answer_end: int = -1
-    parent: 'Candidate' = None
+    paragraph_id: int = None
+    sentence_offsets: List[int] = None
 
     def _text_anchor(self, url, text) -> str:
         if '#' not in url:
             url += '#'
-        text = re.sub(r'\s+', ' ', text)
-        text = text.strip()
         words = text.split()
         url += ':~:text='
         if len(words) > 7:
@@ -75,31 +115,36 @@ class Candidate:
             url += ','
             url += urllib.parse.quote(' '.join(words[-3:])).replace('-', '%2D')
         else:
-            url += urllib.parse.quote(text).replace('-', '%2D')
+            url += urllib.parse.quote(' '.join(words)).replace('-', '%2D')
         return url
 
     @threaded_method
-    def to_search_result(self) -> SearchResult:
-        parent_result = None
-
-        if self.parent is not None:
-            parent_result = self.parent.to_search_result()
-            parent_result.score = max(parent_result.score, self.score)
-        elif self.document.parent_id is not None:
-            parent_result = Candidate(content="", score=self.score, document=self.document.parent).to_search_result()
-
-        answer = TextPart(self.content[self.answer_start: self.answer_end], True)
-        content = [answer]
-
-        if self.answer_end < len(self.content) - 1:
-            words = self.content[self.answer_end:].split()
-            suffix = ' '.join(words[:20])
-            content.append(TextPart(suffix, False))
+    def to_search_result(self, author_images: Dict[Tuple[int, str], Optional[str]]) -> SearchResult:
+        """
+        author_images holds the author images fetched by the previous stages of the search, by data source and url
+        """
+        if self.answer_start != -1:
+            answer = TextPart(self.content[self.answer_start: self.answer_end], True)
+            content = [answer]
+
+            if self.answer_end < len(self.content) - 1:
+                words = self.content[self.answer_end:].split()
+                suffix = ' '.join(words[:20])
+                content.append(TextPart(suffix, False))
+            url = self._text_anchor(self.document.url, answer.content)
+        else:
+            # no answer was extracted (yet), show the beginning of the paragraph
+            words = self.content.split()
+            content = [TextPart(' '.join(words[:30]), False)]
+            url = self.document.url
 
         data_uri = None
         if self.document.data_source.type.name == 'confluence':
-            config = json.loads(self.document.data_source.config)
-            data_uri = get_confluence_user_image(self.document.author_image_url, config['token'])
+            image_key = (self.document.data_source_id, self.document.author_image_url)
+            if image_key not in author_images:
+                config = json.loads(self.document.data_source.config)
+                author_images[image_key] = get_confluence_user_image(self.document.author_image_url, config['token'])
+            data_uri = author_images[image_key]
 
         result = SearchResult(score=(self.score + 12) / 24 * 100,
                               content=content,
@@ -107,7 +152,7 @@ class Candidate:
                               author_image_url=self.document.author_image_url,
                               author_image_data=data_uri,
                               title=self.document.title,
-                              url=self._text_anchor(self.document.url, answer.content),
+                              url=url,
                               time=self.document.timestamp,
                               location=self.document.location,
                               data_source=self.document.data_source.type.name,
@@ -115,12 +160,37 @@ class Candidate:
                               file_type=self.document.file_type,
                               status=self.document.status,
                               is_active=self.document.is_active)
+        return result
+
+
+def _token_counts(tokenizer, pairs: List[Tuple[str, str]], max_length: int) -> List[int]:
+    encoded = tokenizer([pair[0] for pair in pairs], [pair[1] for pair in pairs],
+                        truncation='longest_first', max_length=max_length)
+    return [len(input_ids) for input_ids in encoded['input_ids']]
+
+
+def _order_by_token_count(tokenizer, pairs: List[Tuple[str, str]], max_length: int) -> List[int]:
+    token_counts = _token_counts(tokenizer, pairs, max_length)
+    return sorted(range(len(pairs)), key=lambda i: token_counts[i])
 
-        if parent_result is not None:
-            parent_result.child = result
-            return parent_result
-        else:
-            return result
+
+def _padded_token_count(token_counts: List[int], batch_size: int) -> int:
+    """
+    Number of tokens the model actually processes when every batch is padded to its longest input
+    """
+    return sum(max(token_counts[i:i + batch_size]) * len(token_counts[i:i + batch_size])
+               for i in range(0, len(token_counts), batch_size))
+
+
+def _predict_bucketed(cross_encoder: CrossEncoder, pairs: List[Tuple[str, str]]) -> List[float]:
+    # sort by token count so every batch holds inputs of similar length and little padding is needed
+    order = _order_by_token_count(cross_encoder.tokenizer, pairs, cross_encoder.max_length)
+    sorted_scores = cross_encoder.predict([pairs[i] for i in order], batch_size=CROSS_ENCODER_BATCH_SIZE,
+                                          show_progress_bar=False)
+    scores = [0.0] * len(pairs)
+    for i, score in zip(order, sorted_scores):
+        scores[i] = score.item()
+    return scores
 
 
 def _cross_encode(
@@ -141,79 +211,320 @@ def _cross_encode(
             for content, candidate in zip(contents, candidates)
         ]
 
-    scores = cross_encoder.predict([(query, content) for content in contents], show_progress_bar=False)
+    scores = _predict_bucketed(cross_encoder, [(query, content) for content in contents])
     for candidate, score in zip(candidates, scores):
-        candidate.score = score.item()
+        candidate.score = score
     candidates.sort(key=lambda c: c.score, reverse=True)
     return candidates[:top_k]
 
 
-def _assign_answer_sentence(candidate: Candidate, answer: str):
-    paragraph_sentences = re.split(r'([\.\!\?\:\-] |[\"“\(\)])', candidate.content)
-    sentence = None
-    for i, paragraph_sentence in enumerate(paragraph_sentences):
-        if answer in paragraph_sentence:
-            sentence = paragraph_sentence
-            break
+def _assign_answer_sentence(candidate: Candidate, answer_start: int, answer_end: int):
+    offsets = candidate.sentence_offsets
+    if offsets is None:
+        # paragraphs indexed before sentence offsets were stored
+        offsets = sentence_offsets(candidate.content)
+    candidate.answer_start, candidate.answer_end = sentence_span(candidate.content, offsets,
+                                                                 answer_start, answer_end)
+
+
+def _sentence_windows(candidate: Candidate) -> List[Tuple[int, int]]:
+    offsets = candidate.sentence_offsets or sentence_offsets(candidate.content)
+    if len(offsets) <= QA_WINDOW_SENTENCES:
+        return [(0, len(candidate.content))]
+
+    bounds = offsets + [len(candidate.content)]
+    return [(bounds[i], bounds[i + QA_WINDOW_SENTENCES]) for i in range(len(offsets) - QA_WINDOW_SENTENCES + 1)]
+
+
+def _select_qa_contexts(candidates: List[Candidate], query: str) -> List[Tuple[int, int, int]]:
+    """
+    Returns (candidate index, start, end) of the parts of the candidates the QA model should read
+    """
+    if QA_CONTEXT_MODE == 'paragraph':
+        return [(i, 0, len(candidate.content)) for i, candidate in enumerate(candidates)]
+
+    windows = [(i, start, end)
+               for i, candidate in enumerate(candidates)
+               for start, end in _sentence_windows(candidate)]
+    if QA_CONTEXT_MODE == 'cross_encoder':
+        scores = _predict_bucketed(cross_encoder_large,
+                                   [(query, candidates[i].content[start:end]) for i, start, end in windows])
     else:
-        sentence = answer
-    start = candidate.content.find(sentence)
-    end = start + len(sentence)
-    candidate.answer_start = start
-    candidate.answer_end = end
+        query_terms = set(re.findall(r'\w+', query.lower()))
+        scores = [len(query_terms & set(re.findall(r'\w+', candidates[i].content[start:end].lower())))
+                  for i, start, end in windows]
+
+    # pick the best non overlapping windows of every candidate
+    selected = []
+    windows_per_candidate = [0] * len(candidates)
+    for score, (i, start, end) in sorted(zip(scores, windows), key=lambda item: item[0], reverse=True):
+        if windows_per_candidate[i] == QA_WINDOWS_PER_PARAGRAPH:
+            continue
+        if any(i == j and start < selected_end and selected_start < end
+               for j, selected_start, selected_end in selected):
+            continue
+        selected.append((i, start, end))
+        windows_per_candidate[i] += 1
+    return selected
 
 
 def _find_answers_in_candidates(candidates: List[Candidate], query: str) -> List[Candidate]:
-    contexts = [candidate.content for candidate in candidates]
-    answers = qa_model(question=[query] * len(contexts), context=contexts)
+    cached_spans = AnswerCache.get(query, [(candidate.paragraph_id, candidate.content) for candidate in candidates])
+    logger.info(f'Found {len(cached_spans)} cached answers out of {len(candidates)} candidates')
+    uncached = [candidate for candidate in candidates if candidate.paragraph_id not in cached_spans]
+
+    if uncached:
+        qa_contexts = _select_qa_contexts(uncached, query)
+        contexts = [uncached[i].content[start:end] for i, start, end in qa_contexts]
+        order = _order_by_token_count(qa_model.tokenizer, [(query, context) for context in contexts],
+                                      QA_MAX_SEQ_LENGTH)
+        answers = qa_model(question=[query] * len(contexts), context=[contexts[i] for i in order],
+                           max_seq_len=QA_MAX_SEQ_LENGTH, batch_size=QA_BATCH_SIZE)
+
+        if type(answers) == dict:
+            answers = [answers]
+
+        # keep the best answer of every candidate, mapped back to paragraph offsets
+        best_answers = {}
+        for context_index, answer in zip(order, answers):
+            i, context_start, _ = qa_contexts[context_index]
+            if i not in best_answers or answer['score'] > best_answers[i]['score']:
+                best_answers[i] = {'score': answer['score'],
+                                   'start': context_start + answer['start'],
+                                   'end': context_start + answer['end']}
+
+        new_spans = []
+        for i, answer in best_answers.items():
+            candidate = uncached[i]
+            cached_spans[candidate.paragraph_id] = (answer['start'], answer['end'])
+            new_spans.append((candidate.paragraph_id, candidate.content, answer['start'], answer['end']))
+        AnswerCache.put(query, new_spans)
+
+    for candidate in candidates:
+        answer_start, answer_end = cached_spans[candidate.paragraph_id]
+        _assign_answer_sentence(candidate, answer_start, answer_end)
 
-    if type(answers) == dict:
-        answers = [answers]
+    return candidates
 
-    for candidate, answer in zip(candidates, answers):
-        _assign_answer_sentence(candidate, answer['answer'])
 
-    return candidates
+def _to_naive_utc(time: datetime.datetime) -> datetime.datetime:
+    if time.tzinfo is None:
+        return time
+    return time.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+
 
+def _filter_paragraphs_query(query, filters: SearchFilters):
+    query = query.join(Document, Paragraph.document_id == Document.id)
+    if filters.data_sources:
+        query = query.join(DataSource, Document.data_source_id == DataSource.id) \
+            .join(DataSourceType, DataSource.type_id == DataSourceType.id) \
+            .filter(DataSourceType.name.in_(filters.data_sources))
+    if filters.types:
+        query = query.filter(Document.type.in_([doc_type.value for doc_type in filters.types]))
+    if filters.statuses:
+        query = query.filter(func.lower(Document.status).in_([status.lower() for status in filters.statuses]))
+    if filters.after:
+        query = query.filter(Document.timestamp >= _to_naive_utc(filters.after))
+    if filters.before:
+        query = query.filter(Document.timestamp <= _to_naive_utc(filters.before))
+    return query
+
+
+@dataclass
+class SearchScope:
+    # shards to search, None for all of them
+    data_source_ids: Optional[List[int]] = None
+    # paragraphs the indexes may return, None for all of them
+    allowed_ids: Optional[List[int]] = None
+    # the filters matched too many paragraphs, the retrieved candidates are filtered instead
+    is_post_filtered: bool = False
+
+    def is_empty(self) -> bool:
+        return (self.data_source_ids is not None and len(self.data_source_ids) == 0) or \
+            (self.allowed_ids is not None and len(self.allowed_ids) == 0)
+
+
+def _get_search_scope(filters: Optional[SearchFilters]) -> SearchScope:
+    """
+    The data sources filter selects shards. The ids of the paragraphs matching the other filters are only
+    resolved when there are at most MAX_ALLOWED_IDS of them, broader filters are applied after retrieval.
+    """
+    scope = SearchScope()
+    if filters is None or filters.is_empty():
+        return scope
+
+    with Session() as session:
+        if filters.data_sources:
+            rows = session.query(DataSource.id).join(DataSourceType, DataSource.type_id == DataSourceType.id) \
+                .filter(DataSourceType.name.in_(filters.data_sources)).all()
+            scope.data_source_ids = [row[0] for row in rows]
+            if len(scope.data_source_ids) == 0:
+                return scope
+
+        narrow_filters = dataclasses.replace(filters, data_sources=None)
+        if narrow_filters.is_empty():
+            return scope
+
+        query = _filter_paragraphs_query(session.query(Paragraph.id), narrow_filters)
+        if scope.data_source_ids is not None:
+            query = query.filter(Document.data_source_id.in_(scope.data_source_ids))
+        allowed_ids = [row[0] for row in query.limit(MAX_ALLOWED_IDS + 1).all()]
+        if len(allowed_ids) <= MAX_ALLOWED_IDS:
+            scope.allowed_ids = allowed_ids
+        else:
+            scope.is_post_filtered = True
+
+    return scope
+
+
+def _group_by_parent(candidates: List[Candidate]) \
+        -> Tuple[List[Candidate], Dict[int, Candidate], Dict[int, Candidate]]:
+    """
+    Returns the top level candidates, each shown as its own result, the best of them of every document
+    keyed by document id, and the best child candidate of every parent keyed by the parent document id.
+    Every child is shown under the best paragraph of its parent, the other children of the parent are dropped.
+    """
+    top_level: List[Candidate] = []
+    best_paragraphs: Dict[int, Candidate] = {}
+    best_children: Dict[int, Candidate] = {}
+    for candidate in candidates:
+        if candidate.document.parent_id is None:
+            top_level.append(candidate)
+            group, key = best_paragraphs, candidate.document.id
+        else:
+            group, key = best_children, candidate.document.parent_id
+
+        if key not in group or candidate.score > group[key].score:
+            group[key] = candidate
+
+    return top_level, best_paragraphs, best_children
+
+
+def _to_search_results(candidates: List[Candidate], session,
+                       author_images: Optional[Dict[Tuple[int, str], Optional[str]]] = None) -> List[SearchResult]:
+    if author_images is None:
+        author_images = {}
+    logger.info(f'Parsing {len(candidates)} candidates to search results...')
+    top_level, best_paragraphs, best_children = _group_by_parent(candidates)
+
+    # children whose parent didn't make it to the candidates are shown under their parent document
+    missing_parent_ids = [parent_id for parent_id in best_children if parent_id not in best_paragraphs]
+    if missing_parent_ids:
+        for document in session.query(Document).filter(Document.id.in_(missing_parent_ids)).all():
+            parent = Candidate(content="", score=best_children[document.id].score, document=document)
+            top_level.append(parent)
+            best_paragraphs[document.id] = parent
+
+    to_convert = top_level + list(best_children.values())
+    with ThreadPoolExecutor(max_workers=10) as executor:
+        converted = list(executor.map(lambda c: c.to_search_result(author_images), to_convert))
+    results_by_candidate = {id(candidate): result for candidate, result in zip(to_convert, converted)}
+
+    for parent_id, child in list(best_children.items()):
+        if parent_id in best_paragraphs:
+            parent_result = results_by_candidate[id(best_paragraphs[parent_id])]
+            child_result = results_by_candidate[id(best_children.pop(parent_id))]
+            parent_result.child = child_result
+            parent_result.score = max(parent_result.score, child_result.score)
+
+    result = [results_by_candidate[id(candidate)] for candidate in top_level]
+    # parent document no longer exists
+    result.extend(results_by_candidate[id(child)] for child in best_children.values())
+
+    result.sort(key=lambda r: r.score, reverse=True)
+    return result
+
+
+def search_documents(query: str, top_k: int, filters: Optional[SearchFilters] = None) -> List[SearchResult]:
+    results = []
+    for _, results in search_documents_progressively(query, top_k, filters, stages=[SearchStage.FINAL]):
+        pass
+    return results
+
+
+def _empty_stages(stages: List[SearchStage]) -> Iterator[Tuple[SearchStage, List[SearchResult]]]:
+    for stage in SearchStage:
+        if stage in stages:
+            yield stage, []
+
+
+def search_documents_progressively(query: str, top_k: int, filters: Optional[SearchFilters] = None,
+                                   stages: Optional[List[SearchStage]] = None) \
+        -> Iterator[Tuple[SearchStage, List[SearchResult]]]:
+    """
+    Runs the ranking cascade and yields the results of each of the requested stages (all by default)
+    as soon as it is done, so callers can show preliminary results before the QA model finishes.
+    Every requested stage is yielded, with no results when nothing matches.
+    """
+    if stages is None:
+        stages = list(SearchStage)
+
+    scope = _get_search_scope(filters)
+    if scope.is_empty():
+        yield from _empty_stages(stages)
+        return
+    candidates_factor = POST_FILTER_CANDIDATES_FACTOR if scope.is_post_filtered else 1
 
-def search_documents(query: str, top_k: int) -> List[SearchResult]:
     # Encode the query
     query_embedding = bi_encoder.encode(query, convert_to_tensor=True, show_progress_bar=False)
 
     # Search the index for 100 candidates
     index = FaissIndex.get()
-    results = index.search(query_embedding, BI_ENCODER_CANDIDATES)
+    results = index.search(query_embedding, BI_ENCODER_CANDIDATES * candidates_factor,
+                           allowed_ids=scope.allowed_ids, data_source_ids=scope.data_source_ids)
     results = results[0]
     results = [int(id) for id in results if id != -1]  # filter out empty results
 
-    results += Bm25Index.get().search(query, BM_25_CANDIDATES)
+    results += get_lexical_index().search(query, BM_25_CANDIDATES * candidates_factor,
+                                          allowed_ids=scope.allowed_ids, data_source_ids=scope.data_source_ids)
     # Get the paragraphs from the database
     with Session() as session:
-        paragraphs = session.query(Paragraph).filter(Paragraph.id.in_(results)).all()
+        paragraphs_query = session.query(Paragraph).filter(Paragraph.id.in_(results))
+        if filters is not None and not filters.is_empty():
+            paragraphs_query = _filter_paragraphs_query(paragraphs_query, filters)
+        paragraphs = paragraphs_query.all()
         if len(paragraphs) == 0:
-            return []
-        candidates = [Candidate(content=paragraph.content, document=paragraph.document, score=0.0)
+            yield from _empty_stages(stages)
+            return
+        candidates = [Candidate(content=paragraph.content, document=paragraph.document, score=0.0,
+                                paragraph_id=paragraph.id,
+                                sentence_offsets=decode_offsets(paragraph.sentence_offsets))
                       for paragraph in paragraphs]
 
+        # the author images are fetched once, not again by every stage
+        author_images = {}
+
         # calculate small cross-encoder scores to leave just a few candidates
         logger.info(f'Found {len(candidates)} candidates, filtering...')
         candidates = _cross_encode(cross_encoder_small, query, candidates, BI_ENCODER_CANDIDATES, use_titles=True)
+        if SearchStage.PRELIMINARY in stages:
+            yield SearchStage.PRELIMINARY, _to_search_results(candidates[:top_k], session, author_images)
+
         # calculate large cross-encoder scores to leave just top_k candidates
         candidates = _cross_encode(cross_encoder_large, query, candidates, top_k, use_titles=True)
+        if SearchStage.REFINED in stages:
+            yield SearchStage.REFINED, _to_search_results(candidates, session, author_images)
+
         candidates = _find_answers_in_candidates(candidates, query)
         candidates = _cross_encode(cross_encoder_large, query, candidates, top_k, use_answer=True, use_titles=True)
+        if SearchStage.FINAL in stages:
+            yield SearchStage.FINAL, _to_search_results(candidates, session, author_images)
 
-        logger.info(f'Parsing {len(candidates)} candidates to search results...')
 
-        for possible_child in candidates:
-            if possible_child.document.parent_id is not None:
-                for possible_parent in candidates:
-                    if possible_parent.document.id == possible_child.document.parent_id:
-                        possible_child.parent = possible_parent
-                        candidates.remove(possible_parent)
-                        break
+if __name__ == '__main__':
+    # Measures the padding removed by sorting the cross-encoder inputs by token count
+    import sys
 
-        with ThreadPoolExecutor(max_workers=10) as executor:
-            result = list(executor.map(lambda c: c.to_search_result(), candidates))
-            result.sort(key=lambda r: r.score, reverse=True)
-            return result
+    query = ' '.join(sys.argv[1:]) or 'how do I deploy the server'
+    with Session() as session:
+        sample = [paragraph.content + ' [SEP] ' + paragraph.document.title
+                  for paragraph in session.query(Paragraph).limit(BM_25_CANDIDATES + BI_ENCODER_CANDIDATES)]
+    pairs = [(query, content) for content in sample]
+    counts = _token_counts(cross_encoder_large.tokenizer, pairs, cross_encoder_large.max_length)
+
+    real = sum(counts)
+    unsorted = _padded_token_count(counts, CROSS_ENCODER_BATCH_SIZE)
+    bucketed = _padded_token_count(sorted(counts), CROSS_ENCODER_BATCH_SIZE)
+    print(f'{len(pairs)} pairs, {real} real tokens')
+    print(f'unsorted batches: {unsorted} tokens ({(unsorted - real) / max(unsorted, 1):.0%} padding)')
+    print(f'length-bucketed batches: {bucketed} tokens ({(bucketed - real) / max(bucketed, 1):.0%} padding)')
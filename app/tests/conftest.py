@@ -0,0 +1,9 @@
+import sys
+from pathlib import Path
+from unittest import mock
+
+# the app modules import each other the way main.py runs them, from the app directory
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+# importing models loads (and downloads) every model, the tests don't run them
+sys.modules.setdefault('models', mock.MagicMock(QA_MAX_SEQ_LENGTH=384, BI_ENCODER_MODEL='test-model'))
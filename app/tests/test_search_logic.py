@@ -0,0 +1,101 @@
+import datetime
+from unittest import mock
+
+from schemas import Document, DataSource, DataSourceType
+from search_logic import Candidate, SearchScope, SearchStage, _group_by_parent, _to_search_results, \
+    search_documents_progressively
+
+
+def _document(document_id: int, parent_id: int = None, data_source_type: str = 'jira') -> Document:
+    data_source = DataSource(id=1, type=DataSourceType(name=data_source_type), config='{"token": "token"}')
+    return Document(id=document_id, parent_id=parent_id, data_source_id=1, data_source=data_source, type='issue',
+                    title='title', author='author', author_image_url='https://example.com/author.png',
+                    url='https://example.com', location='location', timestamp=datetime.datetime(2023, 1, 1))
+
+
+def _candidate(document: Document, score: float) -> Candidate:
+    return Candidate(content=f'content of {document.id}', score=score, document=document)
+
+
+def _session_with(documents):
+    session = mock.MagicMock()
+    session.query.return_value.filter.return_value.all.return_value = documents
+    return session
+
+
+def test_several_comments_of_one_issue_are_grouped_under_it():
+    issue = _document(1)
+    issue_candidate = _candidate(issue, 1.0)
+    comments = [_candidate(_document(comment_id, parent_id=1), score)
+                for comment_id, score in [(2, 3.0), (3, 5.0), (4, 2.0)]]
+
+    top_level, best_paragraphs, best_children = _group_by_parent([comments[0], issue_candidate] + comments[1:])
+
+    assert top_level == [issue_candidate]
+    assert best_paragraphs == {1: issue_candidate}
+    assert best_children == {1: comments[1]}
+
+    results = _to_search_results([issue_candidate] + comments, _session_with([]))
+    assert len(results) == 1
+    assert results[0].title == 'title'
+    assert results[0].child.content[0].content == 'content of 3'
+    assert results[0].score == (5.0 + 12) / 24 * 100
+
+
+def test_paragraphs_of_one_document_stay_separate_results():
+    document = _document(1)
+    paragraphs = [_candidate(document, 1.0), _candidate(document, 4.0)]
+    comment = _candidate(_document(2, parent_id=1), 2.0)
+
+    top_level, best_paragraphs, _ = _group_by_parent(paragraphs + [comment])
+    assert top_level == paragraphs
+    assert best_paragraphs == {1: paragraphs[1]}
+
+    results = _to_search_results(paragraphs + [comment], _session_with([]))
+    assert len(results) == 2
+    # the comment is shown under the best paragraph of its parent
+    assert results[0].child is not None
+    assert results[1].child is None
+
+
+def test_parent_missing_from_candidates_is_loaded():
+    issue = _document(1)
+    comment = _candidate(_document(2, parent_id=1), 3.0)
+
+    top_level, best_paragraphs, best_children = _group_by_parent([comment])
+    assert top_level == []
+    assert best_paragraphs == {}
+    assert best_children == {1: comment}
+
+    results = _to_search_results([comment], _session_with([issue]))
+    assert len(results) == 1
+    assert results[0].child.content[0].content == 'content of 2'
+    assert results[0].score == results[0].child.score
+
+
+def test_orphaned_child_is_its_own_result():
+    comment = _candidate(_document(2, parent_id=1), 3.0)
+
+    results = _to_search_results([comment], _session_with([]))
+    assert len(results) == 1
+    assert results[0].child is None
+    assert results[0].content[0].content == 'content of 2'
+
+
+def test_author_images_are_fetched_once_for_all_stages():
+    candidates = [_candidate(_document(1, data_source_type='confluence'), 1.0)]
+    author_images = {}
+
+    with mock.patch('search_logic.get_confluence_user_image', return_value='data:image') as get_image:
+        for _ in SearchStage:
+            results = _to_search_results(candidates, _session_with([]), author_images)
+
+    get_image.assert_called_once_with('https://example.com/author.png', 'token')
+    assert results[0].author_image_data == 'data:image'
+
+
+def test_every_requested_stage_is_sent_when_nothing_matches():
+    with mock.patch('search_logic._get_search_scope', return_value=SearchScope(data_source_ids=[])):
+        assert list(search_documents_progressively('query', 10)) == [(stage, []) for stage in SearchStage]
+        assert list(search_documents_progressively('query', 10, stages=[SearchStage.FINAL])) == \
+            [(SearchStage.FINAL, [])]
@@ -1,7 +1,11 @@
 import logging
 import threading
+from typing import Optional
 
+from data_source.api.async_runtime import AsyncRuntime
 from data_source.api.context import DataSourceContext
+from data_source.api.exception import RateLimitedException
+from data_source.api.rate_limiter import RateLimiter
 from queues.task_queue import TaskQueue, TaskQueueItem, Task
 
 logger = logging.getLogger()
@@ -14,6 +18,7 @@ class Workers:
 
     @classmethod
     def start(cls):
+        TaskQueue.get_instance().exclude_data_sources(RateLimiter.get_unavailable_data_sources)
         for i in range(cls.WORKER_AMOUNT):
             cls._threads.append(threading.Thread(target=cls.run))
         for thread in cls._threads:
@@ -25,7 +30,10 @@ class Workers:
         logging.info('Stop event set, waiting for workers to stop...')
 
         for thread in cls._threads:
-            thread.join()
+            # workers block until a task arrives, wake them up until they see the stop event
+            while thread.is_alive():
+                TaskQueue.get_instance().wake_up()
+                thread.join(timeout=0.1)
         logging.info('Workers stopped')
 
         cls._thread = None
@@ -41,13 +49,48 @@ class Workers:
                 continue
 
             task_data: Task = task_item.task
+            data_source_id = task_data.data_source_id
             try:
-                data_source = DataSourceContext.get_data_source_instance(task_data.data_source_id)
-                data_source.run_task(task_data.function_name, **task_data.kwargs)
+                data_source = DataSourceContext.get_data_source_instance(data_source_id)
+                if not RateLimiter.try_acquire(data_source_id, data_source.RATE_LIMIT):
+                    # another worker took the last slot, leave the task for later
+                    task_queue.nack(id=task_item.queue_item_id)
+                    continue
+            except Exception as e:
+                Workers._on_task_done(task_item, e, acquired=False)
+                continue
+
+            if data_source.is_async_task(task_data.function_name):
+                # the event loop runs it, so this worker can go on dispatching other tasks
+                future = AsyncRuntime.submit(data_source.run_task_async(task_data.function_name,
+                                                                        task_priority=task_data.priority,
+                                                                        **task_data.kwargs))
+                future.add_done_callback(
+                    lambda done, item=task_item: Workers._on_task_done(item, done.exception(), acquired=True))
+                continue
+
+            error = None
+            try:
+                data_source.run_task(task_data.function_name, task_priority=task_data.priority, **task_data.kwargs)
+            except Exception as e:
+                error = e
+            Workers._on_task_done(task_item, error, acquired=True)
+
+    @staticmethod
+    def _on_task_done(task_item: TaskQueueItem, error: Optional[BaseException], acquired: bool):
+        task_queue = TaskQueue.get_instance()
+        task_data: Task = task_item.task
+        try:
+            if error is None:
                 task_queue.ack(id=task_item.queue_item_id)
-            except Exception:
-                logger.exception(f'Failed to ack task {task_data.function_name} '
-                                 f'for data source {task_data.data_source_id}, decrementing remaining attempts')
+            elif isinstance(error, RateLimitedException):
+                # not the task's fault, so it keeps its attempts
+                RateLimiter.throttle(task_data.data_source_id, error.retry_after)
+                task_queue.nack(id=task_item.queue_item_id)
+            else:
+                logger.error(f'Failed to ack task {task_data.function_name} '
+                             f'for data source {task_data.data_source_id}, decrementing remaining attempts',
+                             exc_info=error)
                 try:
                     task_data.attempts -= 1
 
@@ -60,3 +103,6 @@ class Workers:
                 except Exception:
                     logger.exception('Error while handling task that failed...')
                     task_queue.ack_failed(id=task_item.queue_item_id)
+        finally:
+            if acquired:
+                RateLimiter.release(task_data.data_source_id)